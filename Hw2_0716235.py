@@ -4,67 +4,183 @@
 # Due Date: 04/16/2022
 
 
-import re
-from typing import Counter, List, Tuple
-
-import pandas as pd
-import spacy
-from spacy import displacy
-from spacy.tokens import Token
-from spacy.tokens.doc import Doc
+from __future__ import annotations
+
+import logging
+import functools
+import os
+import time
+from enum import Enum
+from typing import TYPE_CHECKING, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+
+from decision_log import DecisionTrace, SetupLogging
+from doc_arrays import DocArrays, GetDocArrays, LabelID, LabelIDs
+from instrument import Stats
+from label_cache import LABELS_FILE, LabelStore, RuleVersion
+from labeling import LabelCSV
+from models import LazyModel
+from parse_cache import STORE_DIR, ModelID
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from spacy.tokens import Token
+    from spacy.tokens.doc import Doc
 
 SUBJECT_DEPS = {"nsubj", "nsubjpass", "csubj", "csubjpass", "agent", "expl"}
 OBJECT_DEPS = {"dobj", "dative", "attr", "oprd", "pobj"}
 NOUN_POS = {"NOUN", "PRON", "PROPN"}
 
-NLP = spacy.load("en_core_web_trf")
+# Integer ids of the labels above, used by the tree rules on DocArrays.
+# They need spaCy's string ids, so they are set by LoadLabelIDs on first use
+SUBJECT_DEP_IDS: FrozenSet[int] = frozenset()
+OBJECT_DEP_IDS: FrozenSet[int] = frozenset()
+NOUN_POS_IDS: FrozenSet[int] = frozenset()
+CONTINUOUS_DEP_IDS: FrozenSet[int] = frozenset()
+PREPOSITION_DEP_IDS: FrozenSet[int] = frozenset()
+PASSIVE_DEP_IDS: FrozenSet[int] = frozenset()
+VERB_ID = AUX_ID = CCONJ_ID = ADP_ID = PRON_ID = -1
+CC_ID = CONJ_ID = AUXPASS_ID = NPADVMOD_ID = -1
+LABEL_IDS_LOADED = False
 
+# Longest chain of conjunctions / ancestor verbs / continuous verbs followed by the tree rules
+MAX_TREE_DEPTH = 64
 
-def show_tree(doc: Doc):
+# Token attributes read by RulesCheck, other pipeline components are excluded
+RULES_ATTRIBUTES = {"text", "pos_", "tag_", "dep_", "ent_type_", "head", "lefts", "rights"}
+
+NLP = LazyModel("en_core_web_trf", attrs=RULES_ATTRIBUTES)
+
+
+logger = logging.getLogger(__name__)
+
+# Per-row decision trace (see EnableTrace), None when tracing is off
+TRACE: Optional[DecisionTrace] = None
+# True when decisions are traced or logged, refreshed by RulesCheck for each row
+TRACING = False
+# Stage timers of RulesCheck (alignment, tree_check), None when not measured
+STATS: Optional[Stats] = None
+
+
+class Reason(Enum):
     '''
-    Show word ,tag, dep, pos, ent, head, left, right of given doc
+    Reason codes of the rule decisions (the value is the DEBUG log message)
     '''
-    print('%10s %5s %10s %10s %10s %10s %10s %10s' %
-          ("word", "tag", "dep", "pos", "entity", "head", "left", "right"))
-    print('=================================================================================================')
-    for word in doc:
-        print('%10s %5s %10s %10s %10s %10s %10s %10s' %
-              (word.text, word.tag_, word.dep_, word.pos_, word.ent_type_, word.head.text, list(word.lefts), list(word.rights)))
+    S_NOT_FOUND = "Subject not found in sentence"
+    V_NOT_FOUND = "Verb not found in sentence"
+    O_NOT_FOUND = "Object not found in sentence"
+    S_EMPTY = "Subject collected S empty"
+    S_HAS_VERB = "Subject cannot include verb"
+    S_NO_NOUN = "Subject not found noun"
+    V_HAS_NOUN = "Verb cannot include noun"
+    V_NO_VERB = "Verb not found verb"
+    O_EMPTY = "Object collected O empty"
+    O_HAS_VERB = "Object cannot include verb"
+    O_NO_NOUN = "Object not found noun"
+    TYPE_CHECK_FAILED = "Not valid when type check"
+    ALIGNMENT = "Parse"
+    SUBJ_DIRECT = "Found subject in direct children."
+    SUBJ_CONJ = "Found subject in conjunction."
+    SUBJ_ANCESTORS = "Found subject in ancestors"
+    SUBJ_NOT_FOUND = "subj not found"
+    OBJ_DIRECT = "Find direct object in right children"
+    OBJ_CONTINUOUS = "Find object in continous verb"
+    OBJ_PREPOSITION = "Find objects in prepositions and its conjunction."
+    OBJ_NOT_FOUND = "obj not found"
 
 
-def read_CSV(path: str) -> pd.DataFrame:
+def note(reason: Reason, *args):
     '''
-    read csv file from given path
+    Record a decision in the row trace and the DEBUG log.
+    Only call it when TRACING is set, so the disabled path costs nothing.
     '''
-    assert path.find(".csv") != -1, "expected to be csv file"
-    df = pd.read_csv(path)
-    return df
+    if TRACE is not None:
+        TRACE.add(reason.name, *args)
+    logger.debug(reason.value + " %s" * len(args), *args)
+
+
+def UpdateTracing() -> bool:
+    global TRACING
+    TRACING = TRACE is not None or logger.isEnabledFor(logging.DEBUG)
+    return TRACING
+
+
+def EnableTrace(path: Optional[str] = None) -> DecisionTrace:
+    '''
+    Write the decisions of every following RulesCheck call to path (JSON lines),
+    or keep them in TRACE.records if path is None
+    '''
+    global TRACE
+    DisableTrace()
+    TRACE = DecisionTrace(path)
+    UpdateTracing()
+    return TRACE
+
+
+def DisableTrace():
+    global TRACE
+    if TRACE is not None:
+        TRACE.close()
+        TRACE = None
+    UpdateTracing()
+
+
+def OpenLabelStore(cache_dir: str = STORE_DIR, prune: bool = False) -> LabelStore:
+    '''
+    Label cache of RulesCheck in cache_dir, for the current model and the
+    current version of the rules (see RuleVersion). With prune, the labels
+    of the other versions of the rules are deleted.
+    '''
+    store = LabelStore(os.path.join(cache_dir, LABELS_FILE), "rules", RuleVersion(RulesCheck), ModelID(NLP))
+    if prune:
+        logger.info("Pruned %d labels of other rule versions", store.prune())
+    return store
+
+
+def LoadLabelIDs():
+    '''
+    Set the label id constants above (imports spaCy, done once)
+    '''
+    global SUBJECT_DEP_IDS, OBJECT_DEP_IDS, NOUN_POS_IDS, CONTINUOUS_DEP_IDS, PREPOSITION_DEP_IDS, PASSIVE_DEP_IDS
+    global VERB_ID, AUX_ID, CCONJ_ID, ADP_ID, PRON_ID, CC_ID, CONJ_ID, AUXPASS_ID, NPADVMOD_ID, LABEL_IDS_LOADED
+    SUBJECT_DEP_IDS = LabelIDs(SUBJECT_DEPS)
+    OBJECT_DEP_IDS = LabelIDs(OBJECT_DEPS)
+    NOUN_POS_IDS = LabelIDs(NOUN_POS)
+    CONTINUOUS_DEP_IDS = LabelIDs({"xcomp", "ccomp"})
+    PREPOSITION_DEP_IDS = LabelIDs({"prep", "agent", "dative"})
+    PASSIVE_DEP_IDS = LabelIDs({"prep", "agent"})
+    VERB_ID, AUX_ID, CCONJ_ID, ADP_ID, PRON_ID = map(LabelID, ["VERB", "AUX", "CCONJ", "ADP", "PRON"])
+    CC_ID, CONJ_ID, AUXPASS_ID, NPADVMOD_ID = map(LabelID, ["cc", "conj", "auxpass", "npadvmod"])
+    LABEL_IDS_LOADED = True
 
 
-def removeSign(x: str):
+def RuleArrays(doc: Doc) -> DocArrays:
     '''
-    Remove (` , '',  \") from the original text.
+    GetDocArrays of doc, with the label ids of the rules loaded
     '''
-    x1 = re.sub("`+|'{2}|\"", " ", x)
-    x2 = re.sub(' +', ' ', x1)
-    return x2
+    if not LABEL_IDS_LOADED:
+        LoadLabelIDs()
+    return GetDocArrays(doc)
 
 
-def lower(x: str):
+def show_tree(doc: Doc):
     '''
-    Transform letter to lower
+    Show word ,tag, dep, pos, ent, head, left, right of given doc
     '''
-    return x.lower()
+    print('%10s %5s %10s %10s %10s %10s %10s %10s' %
+          ("word", "tag", "dep", "pos", "entity", "head", "left", "right"))
+    print('=================================================================================================')
+    for word in doc:
+        print('%10s %5s %10s %10s %10s %10s %10s %10s' %
+              (word.text, word.tag_, word.dep_, word.pos_, word.ent_type_, word.head.text, list(word.lefts), list(word.rights)))
 
 
-def preprocessCSV(df: pd.DataFrame):
+def read_CSV(path: str) -> pd.DataFrame:
     '''
-    Replace bad sign
+    read csv file from given path
     '''
-    df["S"] = df["S"].apply(removeSign).apply(lower)
-    df["V"] = df["V"].apply(removeSign).apply(lower)
-    df["O"] = df["O"].apply(removeSign).apply(lower)
-    df["sentence"] = df["sentence"].apply(removeSign).apply(lower)
+    assert path.find(".csv") != -1, "expected to be csv file"
+    import pandas as pd
+    df = pd.read_csv(path)
     return df
 
 
@@ -100,169 +216,293 @@ def include_verb(collected: List[Token]) -> bool:
     return False
 
 
-def ExtractDocIndexArr(doc: Doc, S: str, V: str, O: str) -> Tuple[bool, List[Token], List[Token], List[Token]]:
+def TokenIndex(doc: Doc) -> Dict[str, List[int]]:
+    '''
+    Map each lowercased token text to its positions in doc (one pass)
+    '''
+    index: Dict[str, List[int]] = {}
+    for token in doc:
+        index.setdefault(token.lower_, []).append(token.i)
+    return index
+
+
+def FindSpans(doc: Doc, index: Dict[str, List[int]], text: str) -> List[Tuple[int, int]]:
     '''
-    Return the location of given text in doc.
+    Return (start, end) of every occurrence of the words of text in doc,
+    overlapping occurrences included.
+
+    Example
+    ---------
+    "the the cat" in "the the the cat" => [(1, 4)]
+    "the" in "the the the cat" => [(0, 1), (1, 2), (2, 3)]
+    '''
+    words = text.lower().split()
+    if len(words) == 0:
+        return []
+    spans = []
+    for start in index.get(words[0], []):
+        end = start + len(words)
+        if end <= len(doc) and all(doc[start + k].lower_ == words[k] for k in range(1, len(words))):
+            spans.append((start, end))
+    return spans
+
+
+def is_subject_token(token: Token) -> bool:
+    return (token.dep_ in SUBJECT_DEPS or token.pos_ in NOUN_POS)\
+        and token.tag_ not in {"PRP$"}\
+        and token.ent_type_ not in {"TIME", "DATE"}
+
+
+def is_object_token(token: Token) -> bool:
+    return (token.dep_ in OBJECT_DEPS or token.pos_ in NOUN_POS)\
+        and token.tag_ not in {"PRP$"}\
+        and token.ent_type_ not in {"TIME", "DATE"}
+
+
+def ValidSubjects(doc: Doc, spans: List[Tuple[int, int]]) -> List[Tuple[int, int, List[Token]]]:
+    '''
+    Keep the subject spans which pass the type check, with their collected tokens
+    '''
+    valid = []
+    for start, end in spans:
+        collected_S = [t for t in doc[start:end] if is_subject_token(t)]
+        if len(collected_S) == 0:
+            reason = Reason.S_EMPTY
+        elif include_verb(collected_S):
+            reason = Reason.S_HAS_VERB
+        elif not include_noun(collected_S):
+            reason = Reason.S_NO_NOUN
+        else:
+            valid.append((start, end, collected_S))
+            continue
+        if TRACING:
+            note(reason, start, end)
+    return valid
+
+
+def ValidVerbs(doc: Doc, spans: List[Tuple[int, int]]) -> List[Tuple[int, int, List[Token]]]:
+    '''
+    Keep the verb spans which pass the type check, with their collected tokens
+    '''
+    valid = []
+    for start, end in spans:
+        collected_V = list(doc[start:end])
+        if include_noun(collected_V):
+            reason = Reason.V_HAS_NOUN
+        elif not include_verb(collected_V):
+            reason = Reason.V_NO_VERB
+        else:
+            valid.append((start, end, collected_V))
+            continue
+        if TRACING:
+            note(reason, start, end)
+    return valid
+
+
+def ValidObjects(doc: Doc, spans: List[Tuple[int, int]]) -> List[Tuple[int, int, List[Token]]]:
+    '''
+    Keep the object spans which pass the type check, with their collected tokens
+    '''
+    valid = []
+    for start, end in spans:
+        collected_O = [t for t in doc[start:end] if is_object_token(t)]
+        if len(collected_O) == 0:
+            reason = Reason.O_EMPTY
+        elif include_verb(collected_O):
+            reason = Reason.O_HAS_VERB
+        elif not include_noun(collected_O):
+            reason = Reason.O_NO_NOUN
+        else:
+            valid.append((start, end, collected_O))
+            continue
+        if TRACING:
+            note(reason, start, end)
+    return valid
+
+
+def ExtractDocAlignments(doc: Doc, S: str, V: str, O: str) -> Iterator[Tuple[List[Token], List[Token], List[Token]]]:
+    '''
+    Yield every alignment (S, V, O) of the given text in doc, in order of
+    position, where S comes before V and V comes before O.
+
+    Every occurrence of S, V and O is found with a token index of the doc
+    (see FindSpans), then each occurrence is type checked on its own:
 
     Rules
     -----------
         1. Subject and Object can not include any verb, and should contain at least one {"NOUN", "PRON", "PROPN"}
         2. Verb cannot inlucde any noun, and should contain at least one {VERB, AUX}
+    '''
+    index = TokenIndex(doc)
+    spans_S = FindSpans(doc, index, S)
+    if len(spans_S) == 0:
+        if TRACING:
+            note(Reason.S_NOT_FOUND)
+        return
+    spans_V = FindSpans(doc, index, V)
+    if len(spans_V) == 0:
+        if TRACING:
+            note(Reason.V_NOT_FOUND)
+        return
+    spans_O = FindSpans(doc, index, O)
+    if len(spans_O) == 0:
+        if TRACING:
+            note(Reason.O_NOT_FOUND)
+        return
+
+    subjects = ValidSubjects(doc, spans_S)
+    verbs = ValidVerbs(doc, spans_V)
+    objects = ValidObjects(doc, spans_O)
+    for _, end_S, collected_S in subjects:
+        for start_V, end_V, collected_V in verbs:
+            if start_V < end_S:
+                continue
+            for start_O, _, collected_O in objects:
+                if start_O < end_V:
+                    continue
+                yield collected_S, collected_V, collected_O
+
+
+def ExtractDocIndexArr(doc: Doc, S: str, V: str, O: str) -> Tuple[bool, List[Token], List[Token], List[Token]]:
+    '''
+    Return the location of given text in doc (the first alignment of
+    ExtractDocAlignments).
 
     if success:
         return (True,S,V,O)
     else:
         return (False, [],[],[])
     '''
-    i, j = 0, 0
+    for collected_S, collected_V, collected_O in ExtractDocAlignments(doc, S, V, O):
+        return True, collected_S, collected_V, collected_O
+    return False, [], [], []
 
-    collected_S = []
-    arr_S = S.split()
-    while i != len(doc) and j != len(arr_S):
-        if doc[i].text == arr_S[j]:
-            if (doc[i].dep_ in SUBJECT_DEPS or doc[i].pos_ in NOUN_POS) and doc[i].tag_ not in {"PRP$"} and doc[i].ent_type_ not in {"TIME", "DATE"}:
-                collected_S.append(doc[i])
-            i += 1
-            j += 1
-        else:
-            collected_S = []
-            i += 1
-            j = 0
-
-    if len(collected_S) == 0:
-        print("Subject collected S empty")
-        return False, [], [], []
-
-    if include_verb(collected_S):
-        print("Subject cannot include verb")
-        return False, [], [], []
-
-    if not include_noun(collected_S):
-        print("Subject not found noun")
-        return False, [], [], []
-
-    j = 0
-    collected_V = []
-    arr_V = V.split()
-    while i != len(doc) and j != len(arr_V):
-        if doc[i].text == arr_V[j]:
-            collected_V.append(doc[i])
-            i += 1
-            j += 1
-        else:
-            collected_V = []
-            i += 1
-            j = 0
-
-    if len(collected_V) == 0:
-        print("Verb collected V empty")
-        return False, [], [], []
-
-    if include_noun(collected_V):
-        print("Verb cannot include noun")
-        return False, [], [], []
-
-    if not include_verb(collected_V):
-        print("Verb not found verb")
-        return False, [], [], []
-
-    j = 0
-    collected_O = []
-    arr_O = O.split()
-    while i != len(doc) and j != len(arr_O):
-        if doc[i].text == arr_O[j]:
-            if (doc[i].dep_ in OBJECT_DEPS or doc[i].pos_ in NOUN_POS)\
-                    and doc[i].tag_ not in {"PRP$"}\
-                    and doc[i].ent_type_ not in {"TIME", "DATE"}:
-                collected_O.append(doc[i])
-            i += 1
-            j += 1
-        else:
-            collected_O = []
-            i += 1
-            j = 0
 
-    if len(collected_O) == 0:
-        print("Object collected O empty")
-        return False, [], [], []
-
-    if include_verb(collected_O):
-        print("Object cannot include verb")
-        return False, [], [], []
+def is_verb_at(a: DocArrays, i: int) -> bool:
+    '''
+    is_verb on DocArrays
+    '''
+    if a.pos[i] == VERB_ID:
+        return True
+    if a.pos[i] == AUX_ID and a.pos[a.head[i]] != VERB_ID:
+        return True
+    return False
 
-    if not include_noun(collected_O):
-        print("Object not found noun")
-        return False, [], [], []
 
-    return True, collected_S, collected_V, collected_O
+def conjuncts(a: DocArrays, tokens: List[int], dep_ids: FrozenSet[int], max_depth: int = MAX_TREE_DEPTH) -> Set[int]:
+    '''
+    Right children joined to tokens by "cc" (dep in dep_ids or "conj"), and
+    the ones joined to those in turn, at most max_depth conjunctions deep.
+    Every token is expanded once.
+    '''
+    found = set()
+    visited = set()
+    work = [(t, 0) for t in tokens]
+    while len(work) > 0:
+        t, depth = work.pop()
+        if t in visited or depth >= max_depth:
+            continue
+        visited.add(t)
+        rights = a.rights[t]
+        if CC_ID in {a.dep[r] for r in rights}:
+            joined = [r for r in rights if a.dep[r] in dep_ids or a.dep[r] == CONJ_ID]
+            found.update(joined)
+            work.extend((r, depth + 1) for r in joined)
+    return found
 
 
-def subj_in_conj_check(noun: Token, subs: List[Token]) -> bool:
+def subjects_in_conj(a: DocArrays, subs: List[int], max_depth: int = MAX_TREE_DEPTH) -> Set[int]:
     '''
     Find subjects in conjunctions.
     '''
-    exist = False
-    for s in subs:
-        rights = list(s.rights)
-        deps = {t.dep_ for t in rights}
-        if "cc" in deps:
-            subjects = [
-                t for t in rights if t.dep_ in SUBJECT_DEPS or t.dep_ == "conj"]
-            exist = (noun in subjects) or subj_in_conj_check(noun, subjects)
-            if exist:
-                return True
-    return False
+    return conjuncts(a, subs, SUBJECT_DEP_IDS, max_depth)
+
+
+def subjects_in_ancestors(a: DocArrays, v: int, max_depth: int = MAX_TREE_DEPTH) -> Set[int]:
+    '''
+    Find subjects in the heads of v: climb to the nearest verb or noun,
+    collect the left children of a verb and keep climbing from it, at most
+    max_depth verbs up
+    '''
+    found = set()
+    visited = set()
+    current = v
+    for _ in range(max_depth):
+        current = a.head[current]
+        while a.pos[current] != VERB_ID and a.pos[current] not in NOUN_POS_IDS and not a.is_root(current):
+            if current in visited:
+                return found
+            visited.add(current)
+            current = a.head[current]
+        if current in visited:
+            break
+        visited.add(current)
+        if a.pos[current] == VERB_ID:
+            subs = a.lefts[current]
+            found.update(subs)
+            found |= subjects_in_conj(a, subs, max_depth)
+            if a.is_root(current):
+                break
+        else:
+            if a.pos[current] in NOUN_POS_IDS:
+                found.add(current)
+            break
+    return found
 
 
-def subj_in_ancestors(noun: Token, v: Token) -> bool:
+def SubjectSet(a: DocArrays, v: int) -> Dict[int, Reason]:
     '''
-    recursively find subjects in current head
+    Every subject of verb v, mapped to how it was found:
+        - SUBJ_DIRECT: direct left children (most common case)
+        - SUBJ_CONJ: conjunction of left children
+        - SUBJ_ANCESTORS: implicit subject from ancesters
+
+    Computed once per verb and kept in a.memo, so every row of the same
+    sentence is a lookup.
     '''
-    current = v.head
-    while current.pos_ != "VERB" and current.pos_ not in NOUN_POS and current.head != current:
-        current = current.head
-    if current.pos_ == "VERB":
-        subs = [t for t in current.lefts]
-        if noun in subs:
-            return True
-        elif subj_in_conj_check(noun, subs):
-            return True
-        elif current.head != current:
-            return subj_in_ancestors(noun, current)
-    elif current.pos_ in NOUN_POS:
-        return noun == current
+    key = ("subjects", v)
+    found = a.memo.get(key)
+    if found is None:
+        lefts = [x for x in a.lefts[v] if a.dep[x] in SUBJECT_DEP_IDS]
+        found = dict.fromkeys(lefts, Reason.SUBJ_DIRECT)
+        if len(lefts) > 0:
+            for t in subjects_in_conj(a, lefts):
+                found.setdefault(t, Reason.SUBJ_CONJ)
+        for t in subjects_in_ancestors(a, v):
+            found.setdefault(t, Reason.SUBJ_ANCESTORS)
+        a.memo[key] = found
+    return found
+
+
+def subject_check(a: DocArrays, noun: int, v: int) -> bool:
+    reason = SubjectSet(a, v).get(noun)
+    if TRACING:
+        note(reason or Reason.SUBJ_NOT_FOUND, noun, v)
+    return reason is not None
 
 
 def SubjectCheck(noun: Token, v: Token) -> bool:
-    lefts = [x for x in v.lefts if x.dep_ in SUBJECT_DEPS]
-    # Find subjects in direct left children (most common case)
-    if noun in lefts:
-        print("Found subject in direct children.")
-        return True
-    # Find subjects in conjunction of left children
-    elif len(lefts) > 0 and subj_in_conj_check(noun, lefts):
-        print("Found subject in conjunction.")
-        return True
-    # Find implicit subject from ancesters
-    if subj_in_ancestors(noun, v):
-        print("Found subject in ancestors")
-        return True
-    return False
+    '''
+    Check noun is a subject of verb v
+    '''
+    UpdateTracing()
+    return subject_check(RuleArrays(v.doc), noun.i, v.i)
 
 
-def is_passive_verb(v: Token) -> bool:
+def is_passive_verb(a: DocArrays, v: int) -> bool:
     '''
     Check if a verb is passive, find auxpass dep_ from its left child
     '''
-    for child in v.lefts:
-        if child.dep_ == "auxpass":
+    for child in a.lefts[v]:
+        if a.dep[child] == AUXPASS_ID:
             return True
     return False
 
 
-def obj_in_continuos_verb(noun: Token, v: Token) -> bool:
+def continuous_verbs(a: DocArrays, v: int) -> List[int]:
     '''
-    Check if a verb's right side is also a verb in to+V or v+Ving form
+    Verbs on a verb's right side in to+V or v+Ving form, whose objects are
+    objects of the verb as well
 
     Example
     ----------
@@ -278,87 +518,127 @@ def obj_in_continuos_verb(noun: Token, v: Token) -> bool:
     for verb kissed
     we have to find obj in hugged
     '''
-    rights = list(v.rights)
+    rights = a.rights[v]
     #  To + V or V + Ving
-    for child in rights:
-        if is_verb(child) and child.dep_ in {"xcomp", "ccomp"}:
-            if ObjectCheck(noun, child):
-                return True
+    verbs = [child for child in rights if is_verb_at(a, child) and a.dep[child] in CONTINUOUS_DEP_IDS]
 
     # VERB + CCONJ + VERB
-    if len(rights) > 1 and rights[0].pos_ == 'CCONJ':
-        for r in rights[1:]:
-            if is_verb(r):
-                if ObjectCheck(noun, r):
-                    return True
-    return False
+    if len(rights) > 1 and a.pos[rights[0]] == CCONJ_ID:
+        verbs.extend(r for r in rights[1:] if is_verb_at(a, r))
+    return verbs
 
 
-def obj_in_conj_check(noun: Token, objs: List[Token]) -> bool:
+def objects_in_continuos_verb(a: DocArrays, v: int, solved: Dict[int, Dict[int, Reason]]) -> Set[int]:
     '''
-    Check conjunction objects joined by "cc"
+    Objects of the continuous verbs of v, solved maps each of them to its ObjectSet
+    (a verb missing from solved contributes nothing)
     '''
-    for o in objs:
-        rights = list(o.rights)
-        deps = {t.dep_ for t in rights}
-        if "cc" in deps:
-            objects = [
-                t for t in rights if t.dep_ in OBJECT_DEPS or t.dep_ == "conj"]
-            if noun in objects:
-                return True
-            if obj_in_conj_check(noun, objects):
-                return True
-    return False
+    found = set()
+    for c in continuous_verbs(a, v):
+        found.update(solved.get(c, ()))
+    return found
 
 
-def obj_in_preposition_check(noun: Token, tokens: List[Token]) -> bool:
+def objects_in_conj(a: DocArrays, objs: List[int], max_depth: int = MAX_TREE_DEPTH) -> Set[int]:
+    '''
+    Conjunction objects joined by "cc"
+    '''
+    return conjuncts(a, objs, OBJECT_DEP_IDS, max_depth)
+
+
+def objects_in_preposition(a: DocArrays, tokens: List[int]) -> Set[int]:
+    found = set()
     for t in tokens:
-        if t.pos_ == "ADP" and t.dep_ in {"prep", "agent", "dative"}:
-            objs = [r for r in t.rights if r.dep_ in OBJECT_DEPS or r.pos_ == "PRON"]
-            if noun in objs:
-                return True
-            if obj_in_conj_check(noun, objs):
-                return True
-    return False
+        if a.pos[t] == ADP_ID and a.dep[t] in PREPOSITION_DEP_IDS:
+            objs = [r for r in a.rights[t] if a.dep[r] in OBJECT_DEP_IDS or a.pos[r] == PRON_ID]
+            found.update(objs)
+            found |= objects_in_conj(a, objs)
+    return found
 
 
-def ObjectCheck(noun: Token, v: Token) -> bool:
+def verb_objects(a: DocArrays, v: int, solved: Dict[int, Dict[int, Reason]]) -> Dict[int, Reason]:
     '''
+    ObjectSet of v, given the ObjectSet of its continuous verbs in solved
+    '''
+    if is_passive_verb(a, v):
+        rights = [x for x in a.rights[v] if
+                  (a.dep[x] in OBJECT_DEP_IDS or a.dep[x] in PASSIVE_DEP_IDS)
+                  and a.dep[x] != NPADVMOD_ID]
+    else:
+        rights = [
+            x for x in a.rights[v] if
+            a.dep[x] in OBJECT_DEP_IDS
+            and a.dep[x] != NPADVMOD_ID]
+    found = dict.fromkeys(rights, Reason.OBJ_DIRECT)
+    for t in objects_in_continuos_verb(a, v, solved):
+        found.setdefault(t, Reason.OBJ_CONTINUOUS)
+    for t in objects_in_preposition(a, rights):
+        found.setdefault(t, Reason.OBJ_PREPOSITION)
+    return found
+
+
+def ObjectSet(a: DocArrays, v: int, max_depth: int = MAX_TREE_DEPTH) -> Dict[int, Reason]:
+    '''
+    Every object of verb v, mapped to how it was found:
+        - OBJ_DIRECT: direct object in right children
+        - OBJ_CONTINUOUS: object of a continuous verb (xcomp, ccomp, VERB + CCONJ + VERB)
+        - OBJ_PREPOSITION: preposition object and its conjunction (often occurs in passive sentence)
+
+    The continuous verbs are solved first (depth first worklist, at most
+    max_depth verbs deep), then the verbs which take their objects. Every
+    complete result is kept in a.memo; a result cut by the depth budget is not.
+
     Example
     ---------
     If Calcavecchia plays Friday morning , he knows the importance of starting well 
 
-    for verb plays, return False:
+    for verb plays, Friday morning is not an object:
         subjects is Calcavecchia
         but Friday morning is a npadvmod(as adverbial modifier) not object
     '''
-    if is_passive_verb(v):
-        rights = [x for x in v.rights if
-                  (x.dep_ in OBJECT_DEPS or x.dep_ in {"prep", "agent"})
-                  and x.dep_ not in {"npadvmod"}]
-    else:
-        rights = [
-            x for x in v.rights if
-            x.dep_ in OBJECT_DEPS
-            and x.dep_ not in {"npadvmod"}]
+    found = a.memo.get(("objects", v))
+    if found is not None:
+        return found
+    solved: Dict[int, Dict[int, Reason]] = {}
+    # verbs whose objects miss a continuous verb past the depth budget
+    cut = set()
+    visited = set()
+    work = [(v, 0, False)]
+    while len(work) > 0:
+        u, depth, ready = work.pop()
+        if ready:
+            if any(c not in solved or c in cut for c in continuous_verbs(a, u)):
+                cut.add(u)
+            solved[u] = verb_objects(a, u, solved)
+            if u not in cut:
+                a.memo[("objects", u)] = solved[u]
+            continue
+        if u in visited:
+            continue
+        visited.add(u)
+        found = a.memo.get(("objects", u))
+        if found is not None:
+            solved[u] = found
+            continue
+        work.append((u, depth, True))
+        if depth < max_depth:
+            work.extend((c, depth + 1, False) for c in continuous_verbs(a, u))
+    return solved[v]
+
+
+def object_check(a: DocArrays, noun: int, v: int) -> bool:
+    reason = ObjectSet(a, v).get(noun)
+    if TRACING:
+        note(reason or Reason.OBJ_NOT_FOUND, noun, v)
+    return reason is not None
 
-    # Direct object
-    if noun in rights:
-        print("Find direct object in right children")
-        return True
-
-    # Continuous verb
-    if obj_in_continuos_verb(noun, v):
-        print("Find object in continous verb")
-        return True
 
-    # Preposition object (often occurs in passive sentence)
-    if obj_in_preposition_check(noun, rights):
-        print("Find objects in prepositions and its conjunction.")
-        return True
-
-    print("obj not found")
-    return False
+def ObjectCheck(noun: Token, v: Token) -> bool:
+    '''
+    Check noun is an object of verb v
+    '''
+    UpdateTracing()
+    return object_check(RuleArrays(v.doc), noun.i, v.i)
 
 
 def RulesCheck(S: str, V: str, O: str, doc: Doc) -> bool:
@@ -367,26 +647,59 @@ def RulesCheck(S: str, V: str, O: str, doc: Doc) -> bool:
 
     Algorithm
     ---------
+    Try every alignment of S, V, O in doc (see ExtractDocAlignments), for each one
     Check subject is in the left side of verb (recursively)
     Check object is in the right side of verb (recursively)
         - if the verb is auxpass, find object in perposition
     '''
-    valid, doc_S, doc_V, doc_O = ExtractDocIndexArr(doc, S, V, O)
+    if UpdateTracing() and TRACE is not None:
+        TRACE.begin(S=S, V=V, O=O, sentence=doc.text)
+    # the alignment search and the tree checks are timed (once per row) when STATS is set
+    stats = STATS
+    clock = time.perf_counter
+    align_time, tree_time = 0.0, 0.0
+    found = False
+    valid = False
+    alignments = ExtractDocAlignments(doc, S, V, O)
+    while not found:
+        start = clock() if stats is not None else 0.0
+        alignment = next(alignments, None)
+        checked_at = clock() if stats is not None else 0.0
+        align_time += checked_at - start
+        if alignment is None:
+            break
+        valid = True
+        found = TreeCheck(*alignment)
+        if stats is not None:
+            tree_time += clock() - checked_at
+    if stats is not None:
+        stats.add_time("alignment", align_time)
+        if valid:
+            stats.add_time("tree_check", tree_time)
     # Type checked failed
-    if not valid:
-        print("Not valid when type check")
-        return False
+    if not valid and TRACING:
+        note(Reason.TYPE_CHECK_FAILED)
+    if TRACE is not None:
+        TRACE.end(int(found))
+    return found
+
 
+def TreeCheck(doc_S: List[Token], doc_V: List[Token], doc_O: List[Token]) -> bool:
+    '''
+    Check one alignment of S, V, O in the dependency tree
+    '''
     # Search in tree
-    print("Parse", doc_S, doc_V, doc_O)
+    if TRACING:
+        note(Reason.ALIGNMENT, [s.i for s in doc_S], [v.i for v in doc_V], [o.i for o in doc_O])
+    a = RuleArrays(doc_V[0].doc)
     for v in doc_V:
         sub_ok, obj_ok = False, False
         for s in doc_S:
-            if SubjectCheck(s, v):
+            if subject_check(a, s.i, v.i):
                 sub_ok = True
                 break
         for o in doc_O:
-            if ObjectCheck(o, v):
+            if object_check(a, o.i, v.i):
                 obj_ok = True
                 break
         if sub_ok and obj_ok:
@@ -394,26 +707,40 @@ def RulesCheck(S: str, V: str, O: str, doc: Doc) -> bool:
     return False
 
 
-def main():
-    path = "answer_trf_invert_auxfix.csv"
-    labels = []
-    df = read_CSV("data.csv")
-    df = preprocessCSV(df)
-    for i in range(len(df)):
-        if i % 20 == 0:
-            print("Perform on row {}".format(i))
-        S, V, O, SENT = df.iloc[i, 1], df.iloc[i, 2],\
-            df.iloc[i, 3], df.iloc[i, 4]
-        valid = RulesCheck(S, V, O, NLP(SENT))
-        if valid:
-            labels.append(1)
-        else:
-            labels.append(0)
-    print(Counter(labels))
-    df["label"] = labels
-    df.to_csv("debug/"+path, index=False)
-    answer = df[["id", "label"]]
-    answer.to_csv(path, index=False)
+def main(log_level: str = "INFO", trace_path: Optional[str] = None, stats_path: Optional[str] = None,
+         label_cache: bool = True, prune_label_cache: bool = False,
+         output_path: str = "answer_trf_invert_auxfix.csv", **options):
+    '''
+    Label a CSV with RulesCheck through labeling.LabelCSV, the options
+    (input_path, debug_dir, model, n_workers, stream, resume, ...) are
+    given to it; the answers are written to output_path.
+    log_level DEBUG logs every rule decision, trace_path writes them as
+    reason codes (one JSON line per row, single process only: ValueError
+    with n_workers > 1).
+    The timings of every stage are logged as JSON at the end (and written to stats_path).
+    label_cache keeps the label of every row in the cache directory (see
+    OpenLabelStore), rows labeled by an earlier run are not parsed again.
+    It is off when the decisions are traced or logged, since cached rows are not checked.
+    prune_label_cache deletes the cached labels of the other versions of the rules.
+    '''
+    global STATS
+    if trace_path is not None and options.get("n_workers", 1) > 1:
+        raise ValueError("trace_path needs a single process, the worker processes do not trace")
+    SetupLogging(log_level)
+    memo = None
+    if label_cache and trace_path is None and log_level != "DEBUG":
+        memo = functools.partial(OpenLabelStore, prune=prune_label_cache)
+    stats = Stats()
+    if trace_path is not None:
+        EnableTrace(trace_path)
+    STATS = stats
+    try:
+        labels = LabelCSV(RulesCheck, memo=memo, stats=stats, output_path=output_path, **options)
+    finally:
+        STATS = None
+        DisableTrace()
+    logger.info("Labels: %s", labels)
+    logger.info("Stats: %s", stats.dump(stats_path))
 
 
 def debug():
@@ -425,6 +752,7 @@ def debug():
     # S, V, O = "anybody", "poked", "fun"
     # doc = NLP("A Spanish official , who had just finished a siesta and seemed not the least bit tense , offered what he believed to be a perfectly reasonable explanation for why the portable facilities were n't in service .")
     # S, V, O = "he","be","explanation"
+    SetupLogging("DEBUG")
     doc = NLP("she gave me a book, kissed me, and hugged me.")
     S, V, O = "she","gave","book"
     show_tree(doc)
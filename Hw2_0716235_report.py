@@ -5,18 +5,22 @@
 
 from typing import List, Literal, Set, Tuple, Union
 import pandas as pd
-import spacy
 from spacy.tokens.doc import Doc
 from spacy.tokens.span import Span
 from spacy.tokens import Token
 
+from models import SIMILARITY_ATTRIBUTES, LazyModel
+from parse_cache import PhraseVectors
+
 DEBUGMODE = True
 
 SUBJECT_DEPS = {"nsubj", "nsubjpass", "csubj", "csubjpass", "agent", "expl"}
 OBJECTS_DEPS = {"dobj", "dative", "attr", "oprd", "pobj"}
 
 # https://www.researchgate.net/publication/228905420_Triplet_extraction_from_sentences
-NLP = spacy.load("en_core_web_sm")
+NLP = LazyModel("en_core_web_sm", attrs=SIMILARITY_ATTRIBUTES)
+# Parsed S/V/O phrases (and their vectors) shared by every CompareSimilarity call
+PHRASES = PhraseVectors(NLP)
 
 
 class Color:
@@ -388,18 +392,14 @@ def CompareSimilarity(S: str, V: str, O: str, answerList: List[List[str]], thres
     '''
     Compare similarity between
     '''
+    S_doc, V_doc, O_doc = PHRASES(S), PHRASES(V), PHRASES(O)
     for sentence in answerList:
-        S_check, V_check, O_check = False, False, False
-        for solution in sentence:
-            S_value = NLP(S).similarity(NLP(solution[0]))
-            V_value = NLP(V).similarity(NLP(solution[1]))
-            O_value = NLP(O).similarity(NLP(solution[2]))
-            if S_value > threshold:
-                S_check = True
-            if V_value > threshold:
-                V_check = True
-            if O_value > threshold:
-                O_check = True
+        S_values = PHRASES.similarity(S_doc, [solution[0] for solution in sentence])
+        V_values = PHRASES.similarity(V_doc, [solution[1] for solution in sentence])
+        O_values = PHRASES.similarity(O_doc, [solution[2] for solution in sentence])
+        S_check = bool((S_values > threshold).any())
+        V_check = bool((V_values > threshold).any())
+        O_check = bool((O_values > threshold).any())
         if S_check and V_check and O_check:
             return 1
     return 0
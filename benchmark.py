@@ -0,0 +1,280 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Benchmark of the rule engines on frozen parses.
+
+The sentences of data.csv are parsed once ("build") and saved with the
+rows and the S/V/O phrases used by the similarity engine. "run" then times
+every engine on that corpus without loading any model, on data.csv and on
+scaled-up copies (each copy gets freshly deserialized Docs, so no per-Doc
+memo carries over), with warmup and repetitions. The results are written
+as JSON and compared to a stored baseline: an engine whose time per row
+grows past max_ratio times the baseline fails the run, and so does a
+missing baseline (write it first with --update-baseline). The similarity
+engine only sees the saved phrases: one missing from the corpus raises.
+
+Example
+---------
+$ python benchmark.py build                       # needs the model, once
+$ python benchmark.py run --update-baseline       # on the reference commit
+$ python benchmark.py run                         # after a rule change
+'''
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import spacy
+import srsly
+from spacy.tokens import DocBin
+from spacy.tokens.doc import Doc
+
+import Hw2_0716235 as rules
+import method1
+import method2
+import method3
+from models import LazyModel
+from parse_cache import ModelID, PhraseVectors
+from preprocess import preprocessCSV
+
+logger = logging.getLogger(__name__)
+
+BENCH_DIR = "bench"
+CORPUS_PATH = os.path.join(BENCH_DIR, "corpus.msgpack")
+RESULTS_PATH = os.path.join(BENCH_DIR, "results.json")
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+SCALES = (1, 10, 100)
+WARMUP = 1
+REPEATS = 5
+# Fail when the median time per row is more than MAX_RATIO times the baseline
+MAX_RATIO = 1.5
+
+# (sentence, [(S, V, O), ...]) in corpus order
+Group = Tuple[str, List[Tuple[str, str, str]]]
+
+
+def _method1_judge(S: str, V: str, O: str, actuals: method1.CandidateMatcher) -> int:
+    return method1.Judge((S, V, O), actuals)
+
+
+# engine name -> (prepare, judge), called like LabelRows does
+ENGINES: Dict[str, Tuple[Optional[Callable[[Doc], Any]], Callable[[str, str, str, Any], int]]] = {
+    "rules": (None, rules.RulesCheck),
+    "similarity": (method3.IndexSVO, method3.CompareSimilarity),
+    "method1": (method1.MatchSVO, _method1_judge),
+    "method2": (None, method2.JudgeDoc),
+}
+
+
+def BuildCorpus(model: str = "en_core_web_trf", csv_path: str = "data.csv", path: str = CORPUS_PATH):
+    '''
+    Parse the distinct sentences of csv_path (preprocessed like Hw2_0716235.main)
+    and save them with their rows and every phrase CompareSimilarity looks up
+    '''
+    nlp = LazyModel(model).load()
+    df = preprocessCSV(rules.read_CSV(csv_path))
+    groups: Dict[str, List[Tuple[str, str, str]]] = {}
+    for S, V, O, sent in zip(df["S"].astype(str), df["V"].astype(str), df["O"].astype(str),
+                             df["sentence"].astype(str)):
+        groups.setdefault(sent, []).append((S, V, O))
+    docs = list(nlp.pipe(groups.keys()))
+    phrases = set()
+    for doc, (sent, rows) in zip(docs, groups.items()):
+        for row in rows:
+            phrases.update(row)
+        for sentence in method3.SVOParse(doc):
+            for solution in sentence:
+                phrases.update(solution)
+    phrases = sorted(phrases)
+    # Doc.to_bytes keeps the tensor, which holds the phrase vectors of the trf model
+    phrase_bytes = {p: doc.to_bytes(exclude=["user_data"]) for p, doc in zip(phrases, nlp.pipe(phrases))}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    srsly.write_msgpack(path, {
+        "model": ModelID(nlp),
+        "docs": DocBin(docs=docs).to_bytes(),
+        "groups": [[sent, [list(row) for row in rows]] for sent, rows in groups.items()],
+        "phrases": phrase_bytes,
+    })
+    logger.info("Saved %d sentences and %d phrases to %s", len(docs), len(phrases), path)
+
+
+class Corpus:
+    '''
+    Frozen corpus written by BuildCorpus
+    '''
+
+    def __init__(self, path: str = CORPUS_PATH):
+        data = srsly.read_msgpack(path)
+        self.model: str = data["model"]
+        # the lexical attributes (lower_, ...) of a blank vocab of the model's
+        # language, a bare Vocab() leaves them empty and no row would align
+        self.vocab = spacy.blank(self.model.split("_", 1)[0]).vocab
+        self.docbin = DocBin().from_bytes(data["docs"])
+        self.groups: List[Group] = [(sent, [tuple(row) for row in rows]) for sent, rows in data["groups"]]
+        self.phrases = {p: Doc(self.vocab).from_bytes(b) for p, b in data["phrases"].items()}
+
+    @property
+    def rows(self) -> int:
+        return sum(len(rows) for _, rows in self.groups)
+
+    def docs(self, scale: int = 1) -> List[Doc]:
+        '''
+        scale copies of the corpus Docs, every one freshly deserialized
+        '''
+        docs = []
+        for _ in range(scale):
+            docs.extend(self.docbin.get_docs(self.vocab))
+        return docs
+
+
+
+class CorpusPhrases(PhraseVectors):
+    '''
+    PhraseVectors of the saved phrase Docs only: a phrase missing from the
+    corpus raises KeyError instead of loading the model to parse it.
+    '''
+
+    def __init__(self, phrases: Dict[str, Doc]):
+        super().__init__(self.missing, max(len(phrases), 1))
+        for p, doc in phrases.items():
+            self.docs.put(p, doc)
+
+    def missing(self, phrase: str):
+        raise KeyError("{!r} is not in the corpus, rebuild it with \"benchmark.py build\"".format(phrase))
+
+    def parse(self, phrases: List[str]) -> List[Doc]:
+        for p in phrases:
+            if p not in self.docs:
+                self.missing(p)
+        return super().parse(phrases)
+
+
+def RunEngine(name: str, groups: List[Group], docs: List[Doc]) -> float:
+    '''
+    Label every row once, return the elapsed seconds
+    '''
+    prepare, judge = ENGINES[name]
+    start = time.perf_counter()
+    for doc, (_, rows) in zip(docs, groups):
+        parsed = doc if prepare is None else prepare(doc)
+        for S, V, O in rows:
+            judge(S, V, O, parsed)
+    return time.perf_counter() - start
+
+
+def TimeEngine(corpus: Corpus, name: str, scale: int, warmup: int = WARMUP,
+               repeats: int = REPEATS) -> Dict[str, Any]:
+    '''
+    Time one engine at one scale, repeats times after warmup runs
+    '''
+    groups = corpus.groups * scale
+    times = []
+    for k in range(warmup + repeats):
+        docs = corpus.docs(scale)
+        elapsed = RunEngine(name, groups, docs)
+        if k >= warmup:
+            times.append(elapsed)
+    rows = corpus.rows * scale
+    median = statistics.median(times)
+    logger.info("%s x%d: %.4fs median (%d rows)", name, scale, median, rows)
+    return {
+        "rows": rows,
+        "times": times,
+        "min": min(times),
+        "median": median,
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "per_row": median / rows,
+        "rows_per_second": rows / median if median > 0 else None,
+    }
+
+
+def Benchmark(corpus: Corpus, engines: List[str], scales=SCALES, warmup: int = WARMUP,
+              repeats: int = REPEATS) -> Dict[str, Any]:
+    '''
+    Time each engine at each scale, with the phrases of the corpus only
+    '''
+    results: Dict[str, Any] = {"model": corpus.model, "rows": corpus.rows, "engines": {}}
+    phrases, method3.PHRASES = method3.PHRASES, CorpusPhrases(corpus.phrases)
+    try:
+        for name in engines:
+            results["engines"][name] = {str(scale): TimeEngine(corpus, name, scale, warmup, repeats)
+                                        for scale in scales}
+    finally:
+        method3.PHRASES = phrases
+    return results
+
+
+def Compare(results: Dict[str, Any], baseline: Dict[str, Any], max_ratio: float = MAX_RATIO) -> List[str]:
+    '''
+    Return a message for every engine and scale slower than max_ratio times the baseline
+    '''
+    regressions = []
+    for name, scales in results["engines"].items():
+        for scale, result in scales.items():
+            base = baseline.get("engines", {}).get(name, {}).get(scale)
+            if base is None:
+                continue
+            ratio = result["per_row"] / base["per_row"]
+            if ratio > max_ratio:
+                regressions.append("{} x{}: {:.2f}x slower per row than baseline ({:.3g}s vs {:.3g}s)".format(
+                    name, scale, ratio, result["per_row"], base["per_row"]))
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="parse data.csv into the frozen corpus")
+    build.add_argument("--model", default="en_core_web_trf")
+    build.add_argument("--csv", default="data.csv")
+    build.add_argument("--corpus", default=CORPUS_PATH)
+    run = sub.add_parser("run", help="time the engines on the frozen corpus")
+    run.add_argument("--corpus", default=CORPUS_PATH)
+    run.add_argument("--engines", nargs="+", default=list(ENGINES), choices=list(ENGINES))
+    run.add_argument("--scales", nargs="+", type=int, default=list(SCALES))
+    run.add_argument("--warmup", type=int, default=WARMUP)
+    run.add_argument("--repeats", type=int, default=REPEATS)
+    run.add_argument("--output", default=RESULTS_PATH)
+    run.add_argument("--baseline", default=BASELINE_PATH)
+    run.add_argument("--max-ratio", type=float, default=MAX_RATIO)
+    run.add_argument("--update-baseline", action="store_true", help="write the results as the new baseline")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.command == "build":
+        BuildCorpus(args.model, args.csv, args.corpus)
+        return 0
+
+    results = Benchmark(Corpus(args.corpus), args.engines, args.scales, args.warmup, args.repeats)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        logger.info("Baseline written to %s", args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        logger.error("No baseline at %s, run with --update-baseline first", args.baseline)
+        return 1
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("model") != results["model"]:
+        logger.warning("Baseline was measured on %s, corpus is %s", baseline.get("model"), results["model"])
+    regressions = Compare(results, baseline, args.max_ratio)
+    for message in regressions:
+        logger.error("REGRESSION %s", message)
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Single entry point of the labeling engines.
+
+Example
+---------
+$ python cli.py rules                                  # same as python Hw2_0716235.py
+$ python cli.py rules --model en_core_web_sm --workers 4 --output answer_sm.csv
+$ python cli.py similarity --debug --batch-size 128
+$ python cli.py rules --stream --chunksize 5000 --resume
+$ python cli.py method1 --output output_test_ignore.csv --dry-run
+$ python cli.py method2 --input data.csv --output answer.csv
+'''
+
+import argparse
+import os
+import sys
+from typing import List, Optional
+
+from labeling import BATCH_SIZE, CHUNK_SIZE, N_PROCESS
+from models import UseModel
+from parse_cache import STORE_DIR
+
+# engine -> (module, default output), the default model is the NLP of each module
+ENGINES = {
+    "rules": ("Hw2_0716235", "answer_trf_invert_auxfix.csv"),
+    "similarity": ("method3", "answer_trf_0413_90_fix.csv"),
+    "method1": ("method1", "output_test_ignore.csv"),
+    "method2": ("method2", "answer.csv"),
+}
+
+
+def BuildParser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--input", default="data.csv", help="CSV with id, S, V, O, sentence")
+    common.add_argument("--output", help="answer CSV (id, label)")
+    common.add_argument("--model", help="spaCy pipeline name or path")
+    common.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="sentences per nlp.pipe batch")
+    common.add_argument("--n-process", type=int, default=N_PROCESS, help="processes used by nlp.pipe")
+
+    engines = argparse.ArgumentParser(add_help=False)
+    engines.add_argument("--workers", type=int, default=1, help="worker processes, each with its own model")
+    engines.add_argument("--model-workers", type=int, default=0,
+                         help="model instances parsing concurrently in this process (ModelPool)")
+    engines.add_argument("--pool-kind", default="thread", choices=["thread", "process"])
+    engines.add_argument("--cache-dir", default=STORE_DIR, help="directory of the parse store")
+    engines.add_argument("--debug-dir", default="debug", help="directory of the debug CSV")
+    engines.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    engines.add_argument("--stats", help="write the stage timings (JSON) to this file")
+    engines.add_argument("--stream", action="store_true", help="read the input in windows, append answers")
+    engines.add_argument("--chunksize", type=int, default=CHUNK_SIZE, help="rows per window with --stream")
+    engines.add_argument("--resume", action="store_true", help="resume a --stream run from its checkpoint")
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="engine", required=True)
+    rules = sub.add_parser("rules", parents=[common, engines], help="dependency rules (Hw2_0716235)")
+    rules.add_argument("--trace", help="write the decision of every row (JSON lines) to this file")
+    rules.add_argument("--no-label-cache", dest="label_cache", action="store_false",
+                       help="label every row, do not read or write the label cache in --cache-dir")
+    rules.add_argument("--prune-label-cache", action="store_true",
+                       help="delete the cached labels of the other versions of the rules")
+    similarity = sub.add_parser("similarity", parents=[common, engines], help="SVO similarity (method3)")
+    similarity.add_argument("--debug", action="store_true", help="log every step, write the debug CSV only")
+    method1 = sub.add_parser("method1", parents=[common], help="FindSVO matching (method1)")
+    method1.add_argument("--dry-run", action="store_true", help="write every column to debug/ instead")
+    sub.add_parser("method2", parents=[common], help="direct dependency check (method2)")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = BuildParser().parse_args(argv)
+    module_name, default_output = ENGINES[args.engine]
+    module = __import__(module_name)
+    output = args.output or default_output
+    if args.engine in ("rules", "similarity"):
+        options = dict(batch_size=args.batch_size, n_process=args.n_process, cache_dir=args.cache_dir,
+                       n_workers=args.workers, log_level=args.log_level, stats_path=args.stats,
+                       stream=args.stream, chunksize=args.chunksize, resume=args.resume,
+                       input_path=args.input, output_path=output, debug_dir=args.debug_dir, model=args.model,
+                       model_workers=args.model_workers, pool_kind=args.pool_kind)
+        if args.engine == "rules":
+            module.main(trace_path=args.trace, label_cache=args.label_cache,
+                        prune_label_cache=args.prune_label_cache, **options)
+        else:
+            module.main(debug=args.debug, **options)
+        return
+    if args.model is not None:
+        UseModel(module, args.model)
+    df = module.readCSV(args.input)
+    if args.engine == "method1":
+        if args.dry_run:
+            os.makedirs("debug", exist_ok=True)
+        module.Parsing(df, output, dry_run=args.dry_run, batch_size=args.batch_size, n_process=args.n_process)
+    else:
+        module.Parsing(df, batch_size=args.batch_size, n_process=args.n_process, output_path=output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
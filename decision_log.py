@@ -0,0 +1,73 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Logging setup and per-row decision trace of the rule engines.
+
+The engines no longer print every decision. Human readable messages go to
+the standard logging module at DEBUG level, and the decisions themselves
+can be written as reason codes, one JSON line per row, with DecisionTrace.
+'''
+
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def SetupLogging(level: str = "INFO", path: Optional[str] = None):
+    '''
+    Configure the root logger, to stderr or to the file at path
+    '''
+    logging.basicConfig(level=getattr(logging, level.upper()), format=LOG_FORMAT,
+                        filename=path, force=True)
+
+
+class DecisionTrace:
+    '''
+    Structured trace of the decisions made for each row, written as JSON lines
+    (or kept in records when path is None)
+
+    Example
+    ---------
+    >>> trace = DecisionTrace("debug/trace.jsonl")
+    >>> trace.begin(S="he", V="knows", O="the importance")
+    >>> trace.add("SUBJ_DIRECT", 8, 9)
+    >>> trace.end(1)
+    {"row": {"S": "he", "V": "knows", "O": "the importance"}, "label": 1, "events": [["SUBJ_DIRECT", 8, 9]]}
+    '''
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._file = open(path, "w", encoding="utf-8") if path is not None else None
+        self.records: List[Dict[str, Any]] = []
+        self._row: Dict[str, Any] = {}
+        self._events: List[list] = []
+
+    def begin(self, **row):
+        self._row = row
+        self._events = []
+
+    def add(self, reason: str, *args):
+        self._events.append([reason, *args])
+
+    def end(self, label: int):
+        record = {"row": self._row, "label": label, "events": self._events}
+        if self._file is not None:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            self.records.append(record)
+        self._row, self._events = {}, []
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
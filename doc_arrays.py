@@ -0,0 +1,103 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Compact per-Doc representation of the dependency tree for the rule engine.
+
+Walking Token objects (list(v.lefts), {t.dep_ for t in rights}, ...) goes
+through the Cython boundary and builds Python objects and strings on every
+step. DocArrays reads the annotations once with doc.to_array and keeps them
+as plain integers (label ids), so the rules can compare ints and test
+membership in int sets.
+'''
+
+from typing import TYPE_CHECKING, Any, Dict, FrozenSet, Hashable, Iterable, List
+
+if TYPE_CHECKING:
+    from spacy.tokens.doc import Doc
+
+
+def LabelID(label: str) -> int:
+    '''
+    Integer id of a label string, as returned by doc.to_array
+    '''
+    from spacy.strings import get_string_id
+    return get_string_id(label)
+
+
+def LabelIDs(labels: Iterable[str]) -> FrozenSet[int]:
+    '''
+    Integer ids of a set of label strings
+    '''
+    from spacy.strings import get_string_id
+    return frozenset(get_string_id(label) for label in labels)
+
+
+class DocArrays:
+    '''
+    Dependency arrays of a Doc, token i is represented by its index.
+
+    Attributes
+    ----------
+    head, dep, pos, tag, ent_type: lists of int (head is the absolute index)
+    lefts, rights: the left / right children of each token, in order
+    left_edge, right_edge: the leftmost / rightmost token of each subtree
+    memo: results the rule engine computed on this doc (ex: subjects of a verb)
+    '''
+
+    def __init__(self, doc: "Doc"):
+        import numpy as np
+        from spacy.attrs import DEP, ENT_TYPE, HEAD, POS, TAG
+        n = len(doc)
+        array = doc.to_array([HEAD, DEP, POS, TAG, ENT_TYPE])
+        # HEAD is stored as a relative offset in an unsigned array
+        head = np.arange(n, dtype=np.int64) + array[:, 0].astype(np.int64)
+        self.n = n
+        self.head: List[int] = head.tolist()
+        self.dep: List[int] = array[:, 1].tolist()
+        self.pos: List[int] = array[:, 2].tolist()
+        self.tag: List[int] = array[:, 3].tolist()
+        self.ent_type: List[int] = array[:, 4].tolist()
+        self.lefts: List[List[int]] = [[] for _ in range(n)]
+        self.rights: List[List[int]] = [[] for _ in range(n)]
+        for i, h in enumerate(self.head):
+            if i < h:
+                self.lefts[h].append(i)
+            elif i > h:
+                self.rights[h].append(i)
+        self.left_edge: List[int] = list(range(n))
+        self.right_edge: List[int] = list(range(n))
+        for i in self._bottom_up():
+            if len(self.lefts[i]) > 0:
+                self.left_edge[i] = self.left_edge[self.lefts[i][0]]
+            if len(self.rights[i]) > 0:
+                self.right_edge[i] = self.right_edge[self.rights[i][-1]]
+        self.memo: Dict[Hashable, Any] = {}
+
+    def _bottom_up(self) -> List[int]:
+        '''
+        Token indices ordered so that children come before their head
+        '''
+        order = [i for i in range(self.n) if self.head[i] == i]
+        for i in order:
+            order.extend(self.lefts[i])
+            order.extend(self.rights[i])
+        return order[::-1]
+
+    def is_root(self, i: int) -> bool:
+        return self.head[i] == i
+
+
+def GetDocArrays(doc: "Doc") -> DocArrays:
+    '''
+    Return the DocArrays of doc, built on first use and kept on doc._.dep_arrays
+    '''
+    if not doc.has_extension("dep_arrays"):
+        doc.set_extension("dep_arrays", default=None)
+    arrays = doc._.dep_arrays
+    if arrays is None:
+        arrays = DocArrays(doc)
+        doc._.dep_arrays = arrays
+    return arrays
@@ -0,0 +1,110 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Timers and counters for the stages of a labeling run.
+
+A Stats object records how long each stage took (every call, so that
+percentiles can be reported) and arbitrary counters (rows, cache hits...).
+summary() turns them into a JSON-friendly dict which main() writes at the
+end of a run, so runs of different rule versions can be compared.
+'''
+
+import json
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+PERCENTILES = (50, 90, 99)
+
+
+class Stats:
+    '''
+    Registry of stage timers and counters
+
+    Example
+    ---------
+    >>> stats = Stats()
+    >>> with stats.timer("read_csv"):
+    ...     df = read_CSV("data.csv")
+    >>> stats.count("rows", len(df))
+    >>> stats.dump("stats.json")
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+        self.counters: Counter = Counter()
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage].append(time.perf_counter() - start)
+
+    def add_time(self, stage: str, seconds: float):
+        self.timings[stage].append(seconds)
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def merge(self, other: "Stats"):
+        '''
+        Add the timings and counters of another Stats (ex: from a worker process)
+        '''
+        for stage, values in other.timings.items():
+            self.timings[stage].extend(values)
+        self.counters.update(other.counters)
+
+    def hit_rate(self, name: str) -> Optional[float]:
+        '''
+        name_hits / (name_hits + name_misses), None if never counted
+        '''
+        hits, misses = self.counters[name + "_hits"], self.counters[name + "_misses"]
+        if hits + misses == 0:
+            return None
+        return hits / (hits + misses)
+
+    def summary(self) -> Dict[str, Any]:
+        import numpy as np
+        wall = time.perf_counter() - self.started
+        stages = {}
+        for stage, values in self.timings.items():
+            array = np.asarray(values)
+            stage_summary = {
+                "calls": len(values),
+                "total": float(array.sum()),
+                "mean": float(array.mean()),
+                "max": float(array.max()),
+            }
+            for q, value in zip(PERCENTILES, np.percentile(array, PERCENTILES)):
+                stage_summary["p{}".format(q)] = float(value)
+            stages[stage] = stage_summary
+        caches = {}
+        for name in self.counters:
+            if name.endswith("_hits"):
+                cache = name[:-len("_hits")]
+                caches[cache] = self.hit_rate(cache)
+        rows = self.counters.get("rows", 0)
+        return {
+            "wall_seconds": wall,
+            "rows_per_second": rows / wall if wall > 0 else None,
+            "stages": stages,
+            "counters": dict(self.counters),
+            "cache_hit_rates": caches,
+        }
+
+    def dump(self, path: Optional[str] = None) -> str:
+        '''
+        Return the summary as JSON, also written to path if given
+        '''
+        text = json.dumps(self.summary(), indent=2, sort_keys=True)
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        return text
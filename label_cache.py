@@ -0,0 +1,221 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Persistent label cache of the rule engines, across runs and datasets.
+
+The label of a row only depends on its (preprocessed) S, V, O and sentence,
+the rule code and the model, so a row seen in an earlier batch does not
+need to be parsed again. LabelStore keeps (row -> label) in SQLite, keyed
+by a hash of the quadruple, the engine, its rule version and the model.
+The rule version is a hash of the code of the rule functions and of the
+constants they read (see RuleVersion): when a rule changes, the labels of
+the old version are never hit again. They stay in the file until
+LabelStore.prune is called, so runs of different revisions can share it.
+'''
+
+import ast
+import dis
+import hashlib
+import inspect
+import os
+import sqlite3
+import textwrap
+from types import CodeType
+from typing import Any, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+# Default file of the label cache, in the parse store directory
+LABELS_FILE = "labels.sqlite"
+# Keys per SELECT ... IN (...), below the SQLite limit of host parameters
+QUERY_SIZE = 500
+
+Row = Tuple[str, str, str, str]
+
+
+def _code_objects(code: CodeType) -> Iterator[CodeType]:
+    '''
+    code and the code of its nested functions, lambdas and comprehensions
+    '''
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            yield from _code_objects(const)
+
+
+def _normalized_source(obj) -> str:
+    '''
+    Syntax tree of the source of a function or class, without comments and docstrings
+    '''
+    tree = ast.parse(textwrap.dedent(inspect.getsource(obj)))
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and len(node.body) > 1:
+            first = node.body[0]
+            if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) \
+                    and isinstance(first.value.value, str):
+                node.body = node.body[1:]
+    return ast.dump(tree)
+
+
+def _is_constant(value: Any) -> bool:
+    if isinstance(value, (bool, int, float, str)):
+        return True
+    if isinstance(value, (set, frozenset, tuple, list)):
+        return all(_is_constant(item) for item in value)
+    if isinstance(value, dict):
+        return all(_is_constant(k) and _is_constant(v) for k, v in value.items())
+    return False
+
+
+def _constant_repr(value: Any) -> str:
+    if isinstance(value, (set, frozenset)):
+        return "{" + ",".join(sorted(_constant_repr(item) for item in value)) + "}"
+    if isinstance(value, dict):
+        return "{" + ",".join(sorted(_constant_repr(k) + ":" + _constant_repr(v) for k, v in value.items())) + "}"
+    if isinstance(value, (tuple, list)):
+        return "[" + ",".join(_constant_repr(item) for item in value) + "]"
+    return repr(value)
+
+
+def RuleVersion(*rules) -> str:
+    '''
+    Hash of the rules: the code of the given functions and of every function
+    and class of the same source directory they use (recursively), and the
+    values of the plain constants (numbers, strings and their sets, ...)
+    they read. Comments and docstrings are not part of it, and neither are
+    the globals the rules assign (ex: lazily loaded label ids, trace state).
+
+    Example
+    ---------
+    >>> RuleVersion(RulesCheck)
+    '3f1c0a9b6d2e4f58'
+    '''
+    roots = {os.path.dirname(os.path.abspath(inspect.getfile(rule))) for rule in rules}
+    seen: Set[int] = set()
+    stack = list(rules)
+    sources: List[str] = []
+    reads: List[Tuple[str, Any]] = []
+    assigned: Set[str] = set()
+    while len(stack) > 0:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        sources.append(obj.__qualname__ + "\0" + _normalized_source(obj))
+        functions = [obj] if inspect.isfunction(obj) else \
+            [f for f in vars(obj).values() if inspect.isfunction(f)]
+        for function in functions:
+            # default values are evaluated once, their names are not in the code
+            for k, value in enumerate((function.__defaults__ or ()) + tuple((function.__kwdefaults__ or {}).values())):
+                if _is_constant(value):
+                    reads.append(("{}#{}".format(function.__qualname__, k), value))
+            for code in _code_objects(function.__code__):
+                names = set()
+                for instruction in dis.get_instructions(code):
+                    if instruction.opname in ("STORE_GLOBAL", "DELETE_GLOBAL"):
+                        assigned.add(instruction.argval)
+                    elif instruction.opname == "LOAD_GLOBAL":
+                        names.add(instruction.argval)
+                for name in sorted(names):
+                    if name not in function.__globals__:
+                        continue
+                    value = function.__globals__[name]
+                    if inspect.isfunction(value) or inspect.isclass(value):
+                        try:
+                            path = os.path.abspath(inspect.getfile(value))
+                        except TypeError:
+                            continue
+                        if os.path.dirname(path) in roots:
+                            stack.append(value)
+                    elif _is_constant(value):
+                        reads.append((name, value))
+    digest = hashlib.sha1()
+    for source in sorted(sources):
+        digest.update(source.encode("utf-8"))
+    for name, value in sorted(set((name, _constant_repr(value)) for name, value in reads)):
+        if name not in assigned:
+            digest.update("{}={}\0".format(name, value).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class LabelStore:
+    '''
+    SQLite table of the labels of (S, V, O, sentence) rows for one engine,
+    rule version and model.
+
+    Example
+    ---------
+    >>> memo = LabelStore(".parse_cache/labels.sqlite", "rules", RuleVersion(RulesCheck), ModelID(NLP))
+    >>> memo.get_many([("she", "kissed", "me", "she kissed and hugged me .")])
+    [None]
+    >>> memo.put_many([("she", "kissed", "me", "she kissed and hugged me .")], [1])
+    >>> memo.close()
+    '''
+
+    def __init__(self, path: str, engine: str, rules: str, model: str):
+        self.path = path
+        self.engine = engine
+        self.rules = rules
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS labels ("
+                "key TEXT PRIMARY KEY, engine TEXT NOT NULL, rules TEXT NOT NULL, label INTEGER NOT NULL"
+                ") WITHOUT ROWID")
+
+    def key(self, row: Row) -> str:
+        '''
+        Hash of the row for the store's engine, rule version and model
+        '''
+        text = "\0".join((self.engine, self.rules, self.model) + tuple(row))
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM labels WHERE engine = ?", (self.engine,)).fetchone()[0]
+
+    def get_many(self, rows: Sequence[Row]) -> List[Optional[int]]:
+        '''
+        Label of every row, None for the rows never labeled
+        '''
+        keys = [self.key(row) for row in rows]
+        found = {}
+        for start in range(0, len(keys), QUERY_SIZE):
+            chunk = keys[start:start + QUERY_SIZE]
+            query = "SELECT key, label FROM labels WHERE key IN ({})".format(",".join("?" * len(chunk)))
+            found.update(self._db.execute(query, chunk).fetchall())
+        labels = [found.get(key) for key in keys]
+        missing = labels.count(None)
+        self.hits += len(labels) - missing
+        self.misses += missing
+        return labels
+
+    def put_many(self, rows: Iterable[Row], labels: Iterable[int]):
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO labels (key, engine, rules, label) VALUES (?, ?, ?, ?)",
+                ((self.key(row), self.engine, self.rules, int(label)) for row, label in zip(rows, labels)))
+
+    def prune(self) -> int:
+        '''
+        Delete the labels of the other rule versions of this engine (they
+        can never be hit by this version), return how many were deleted
+        '''
+        with self._db:
+            cursor = self._db.execute("DELETE FROM labels WHERE engine = ? AND rules != ?",
+                                      (self.engine, self.rules))
+        return cursor.rowcount
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,517 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Shared labeling engine.
+
+Every engine (rules in Hw2_0716235, similarity in method3, method1, method2)
+labels a row from its (S, V, O) strings and the parsed sentence. Instead of
+calling the model once per row, the engine groups the rows by sentence and
+streams the distinct sentences through nlp.pipe, so the transformer gets
+batches and each sentence is parsed exactly once.
+
+LabelCSV is the driver shared by the engines' main: it labels a CSV with
+an engine's judge in the serial, sharded or streamed mode.
+'''
+
+from __future__ import annotations
+
+import functools
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from instrument import Stats
+from model_pool import ModelPool
+from models import LoadModel, UseModel
+from parse_cache import STORE_DIR, DocCache, DocStore
+from preprocess import TEXT_COLUMNS, preprocessCSV
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from spacy.language import Language
+    from spacy.tokens.doc import Doc
+
+logger = logging.getLogger(__name__)
+
+# Default number of sentences per nlp.pipe batch
+BATCH_SIZE = 64
+# Default number of processes used by nlp.pipe
+N_PROCESS = 1
+# Number of shards given to each worker by LabelSharded (for load balancing)
+SHARDS_PER_WORKER = 4
+# Default number of CSV rows read at once by LabelStream
+CHUNK_SIZE = 10000
+# Default number of Docs kept by LabelStream to reuse across windows
+STREAM_CACHE_SIZE = 4096
+# Checkpoint file of a LabelStream run, next to its answer file
+CHECKPOINT_SUFFIX = ".ckpt.json"
+
+# Model and parse store of the current LabelSharded worker process
+_WORKER_NLP = None
+_WORKER_CACHE = None
+
+
+def GroupRowsBySentence(sentences: Iterable[str]) -> Dict[str, List[int]]:
+    '''
+    Map each distinct sentence to the row positions that use it
+    (in order of first appearance).
+    '''
+    groups: Dict[str, List[int]] = {}
+    for i, sent in enumerate(sentences):
+        groups.setdefault(sent, []).append(i)
+    return groups
+
+
+def PipeDocs(nlp: Language, items: Iterable[Tuple[str, Any]], batch_size: int = BATCH_SIZE,
+             n_process: int = N_PROCESS, cache=None) -> Iterator[Tuple[Doc, Any]]:
+    '''
+    Parse (text, context) pairs with nlp.pipe and yield (doc, context).
+
+    If a cache (any object with get(text) and put(text, doc)) is given,
+    texts found in it are yielded first without parsing, and the freshly
+    parsed docs are put into it. The output order is therefore not the
+    input order; use the context to map a doc back to its rows.
+    '''
+    if cache is not None:
+        misses = []
+        for text, context in items:
+            doc = cache.get(text)
+            if doc is None:
+                misses.append((text, context))
+            else:
+                yield doc, context
+        items = misses
+    keyed = ((text, (text, context)) for text, context in items)
+    for doc, (text, context) in nlp.pipe(keyed, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        if cache is not None:
+            cache.put(text, doc)
+        yield doc, context
+
+
+def LabelRows(df: pd.DataFrame, nlp: Language, judge: Callable[[str, str, str, Any], int],
+              prepare: Optional[Callable[[Doc], Any]] = None, batch_size: int = BATCH_SIZE,
+              n_process: int = N_PROCESS, cache=None, stats: Optional[Stats] = None, memo=None) -> List[int]:
+    '''
+    Label every row of df (columns S, V, O, sentence) and return the labels
+    in row order.
+
+    Parameters
+    ----------
+    judge: called as judge(S, V, O, parsed) for each row, returns 0 or 1
+    prepare: optional per-sentence step run once on each Doc (ex: SVOParse),
+        its result is passed to judge instead of the Doc
+    batch_size, n_process: forwarded to nlp.pipe
+    cache: optional Doc cache, see PipeDocs
+    stats: optional Stats, records the time spent waiting for each parsed
+        sentence ("parse"), in prepare and judge, and per sentence ("sentence")
+    memo: optional label cache (label_cache.LabelStore), see MemoLabels
+
+    Example
+    ---------
+    >>> labels = LabelRows(df, NLP, RulesCheck)
+    >>> labels = LabelRows(df, NLP, CompareSimilarity, prepare=SVOParse)
+    '''
+    if memo is not None:
+        return MemoLabels(df, memo, lambda rows: LabelRows(rows, nlp, judge, prepare, batch_size,
+                                                            n_process, cache, stats), stats)
+    S, V, O = df["S"].astype(str).tolist(), df["V"].astype(str).tolist(), df["O"].astype(str).tolist()
+    groups = GroupRowsBySentence(df["sentence"].astype(str))
+    labels: List[int] = [0] * len(df)
+    if stats is not None:
+        return _label_rows_timed(S, V, O, groups, labels, nlp, judge, prepare, batch_size, n_process, cache, stats)
+    done = 0
+    for doc, rows in PipeDocs(nlp, groups.items(), batch_size, n_process, cache):
+        parsed = doc if prepare is None else prepare(doc)
+        for i in rows:
+            labels[i] = int(judge(S[i], V[i], O[i], parsed))
+        done += 1
+        if done % 20 == 0:
+            logger.info("Labeled %d/%d sentences", done, len(groups))
+    return labels
+
+
+def MemoLabels(df: pd.DataFrame, memo, label: Callable[[pd.DataFrame], List[int]],
+               stats: Optional[Stats] = None) -> List[int]:
+    '''
+    Labels of df from memo (label_cache.LabelStore). Only the rows it does
+    not know are labeled, with label(rows), and added to memo; a window of
+    rows which were all labeled before needs no parsing at all.
+    '''
+    rows = list(zip(df["S"].astype(str), df["V"].astype(str), df["O"].astype(str), df["sentence"].astype(str)))
+    labels = memo.get_many(rows)
+    missing = [i for i, label in enumerate(labels) if label is None]
+    if stats is not None:
+        # the rows labeled below are counted by label
+        stats.count("rows", len(rows) - len(missing))
+        stats.count("memo_hits", len(rows) - len(missing))
+        stats.count("memo_misses", len(missing))
+    if len(missing) > 0:
+        new = label(df.iloc[missing].reset_index(drop=True))
+        for i, value in zip(missing, new):
+            labels[i] = value
+        memo.put_many([rows[i] for i in missing], new)
+    return labels
+
+
+def _label_rows_timed(S, V, O, groups, labels, nlp, judge, prepare, batch_size, n_process, cache,
+                      stats: Stats) -> List[int]:
+    '''
+    LabelRows loop with every stage timed into stats
+    '''
+    clock = time.perf_counter
+    docs = PipeDocs(nlp, groups.items(), batch_size, n_process, cache)
+    done = 0
+    while True:
+        start = clock()
+        item = next(docs, None)
+        parsed_at = clock()
+        if item is None:
+            break
+        # nlp.pipe parses a whole batch at once, so most waits are ~0 and one per batch is long
+        stats.add_time("parse", parsed_at - start)
+        doc, rows = item
+        if prepare is None:
+            parsed = doc
+        else:
+            parsed = prepare(doc)
+            stats.add_time("prepare", clock() - parsed_at)
+        for i in rows:
+            judged_at = clock()
+            labels[i] = int(judge(S[i], V[i], O[i], parsed))
+            stats.add_time("judge", clock() - judged_at)
+        stats.add_time("sentence", clock() - parsed_at)
+        stats.count("rows", len(rows))
+        stats.count("sentences")
+        done += 1
+        if done % 20 == 0:
+            logger.info("Labeled %d/%d sentences", done, len(groups))
+    return labels
+
+
+def ShardRows(sentences: Iterable[str], n_shards: int) -> List[List[int]]:
+    '''
+    Split the row positions into at most n_shards shards of about the same
+    number of rows. Rows of the same sentence always stay in one shard.
+    '''
+    groups = list(GroupRowsBySentence(sentences).values())
+    total = sum(len(rows) for rows in groups)
+    size = max(1, -(-total // max(1, n_shards)))
+    shards: List[List[int]] = [[]]
+    for rows in groups:
+        if len(shards[-1]) >= size:
+            shards.append([])
+        shards[-1].extend(rows)
+    return [shard for shard in shards if len(shard) > 0]
+
+
+def _init_worker(load_model: Callable[[], Language], cache_dir: Optional[str]):
+    '''
+    Load the model (and the parse store, read only) once per worker process
+    '''
+    global _WORKER_NLP, _WORKER_CACHE
+    _WORKER_NLP = load_model()
+    if cache_dir is not None:
+        from parse_cache import DocStore
+        _WORKER_CACHE = DocStore(cache_dir, _WORKER_NLP, readonly=True)
+
+
+def _label_shard(args) -> Tuple[List[int], List[int], Optional[Stats], List[Tuple[str, bytes]]]:
+    rows, shard, judge, prepare, batch_size, timed = args
+    stats = Stats() if timed else None
+    labels = LabelRows(shard, _WORKER_NLP, judge, prepare, batch_size=batch_size,
+                       n_process=1, cache=_WORKER_CACHE, stats=stats)
+    new = []
+    if _WORKER_CACHE is not None:
+        if stats is not None:
+            stats.count("store_hits", _WORKER_CACHE.hits)
+            stats.count("store_misses", _WORKER_CACHE.misses)
+        _WORKER_CACHE.hits = _WORKER_CACHE.misses = 0
+        # the Docs parsed for this shard go back to the parent, which owns the store
+        new = _WORKER_CACHE.take_new()
+    return rows, labels, stats, new
+
+
+def LabelSharded(df: pd.DataFrame, load_model: Callable[[], Language], judge: Callable[[str, str, str, Any], int],
+                 prepare: Optional[Callable[[Doc], Any]] = None, n_workers: Optional[int] = None,
+                 batch_size: int = BATCH_SIZE, cache_dir: Optional[str] = None,
+                 stats: Optional[Stats] = None, memo=None, store=None) -> List[int]:
+    '''
+    Same as LabelRows, but the rows are split into shards by sentence and
+    labeled by n_workers processes (default: every core). Each worker calls
+    load_model once. Labels are merged back by row position, so the result
+    is identical to the serial LabelRows.
+
+    judge, prepare and load_model are sent to the workers, so they must be
+    module level functions. The Stats of each shard are merged into stats.
+    The label cache memo is only read and written here, the workers get the
+    rows it misses.
+    The workers read the parse store in cache_dir; the Docs they parse are
+    sent back with each shard and added to store (the same store opened in
+    this process, saved by the caller).
+
+    Example
+    ---------
+    >>> store = DocStore(".parse_cache", NLP)
+    >>> labels = LabelSharded(df, LoadModel, RulesCheck, n_workers=8, cache_dir=".parse_cache", store=store)
+    >>> store.save()
+    '''
+    if memo is not None:
+        return MemoLabels(df, memo, lambda rows: LabelSharded(rows, load_model, judge, prepare, n_workers,
+                                                               batch_size, cache_dir, stats, store=store), stats)
+    n_workers = n_workers or os.cpu_count() or 1
+    columns = df[["S", "V", "O", "sentence"]]
+    shards = ShardRows(columns["sentence"].astype(str), n_workers * SHARDS_PER_WORKER)
+    tasks = ((rows, columns.iloc[rows], judge, prepare, batch_size, stats is not None) for rows in shards)
+    labels: List[int] = [0] * len(df)
+    with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(load_model, cache_dir)) as pool:
+        for done, (rows, shard_labels, shard_stats, new) in enumerate(pool.imap_unordered(_label_shard, tasks), 1):
+            for i, label in zip(rows, shard_labels):
+                labels[i] = label
+            if shard_stats is not None:
+                stats.merge(shard_stats)
+            if store is not None:
+                store.add_new(new)
+            logger.info("Labeled %d/%d shards", done, len(shards))
+    return labels
+
+
+def ReadWindows(path: str, chunksize: int = CHUNK_SIZE, skip: int = 0) -> Iterator[pd.DataFrame]:
+    '''
+    Read a CSV in chunks of about chunksize rows, after the first skip rows.
+    The trailing rows of the last sentence of a chunk are held back and
+    joined to the next one, so contiguous rows of a sentence are always in
+    the same window.
+    The text columns are always read as strings: read_csv infers the dtypes
+    of each chunk separately, and a chunk whose O is only "1872" would
+    otherwise get an int column.
+    '''
+    import numpy as np
+    import pandas as pd
+    carry = None
+    dtype = dict.fromkeys(TEXT_COLUMNS, str)
+    for chunk in pd.read_csv(path, chunksize=chunksize, skiprows=range(1, skip + 1), dtype=dtype):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        sentences = chunk["sentence"].to_numpy()
+        others = np.nonzero(sentences != sentences[-1])[0]
+        cut = others[-1] + 1 if len(others) > 0 else 0
+        carry = chunk.iloc[cut:]
+        if cut > 0:
+            yield chunk.iloc[:cut]
+    if carry is not None and len(carry) > 0:
+        yield carry
+
+
+def AppendCSV(df: pd.DataFrame, path: str, header: bool):
+    '''
+    Append the rows of df to path (with the header only if asked) and flush them to disk
+    '''
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        df.to_csv(f, header=header, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def SaveCheckpoint(path: str, state: Dict[str, Any]):
+    '''
+    Write the checkpoint state as JSON (atomically replace the old file)
+    '''
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def LoadCheckpoint(path: str) -> Optional[Dict[str, Any]]:
+    '''
+    Return the checkpoint state saved at path, None if there is none
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _output_size(path: Optional[str]) -> Optional[int]:
+    return os.path.getsize(path) if path is not None and os.path.exists(path) else None
+
+
+def LabelStream(path: str, nlp: Language, judge: Callable[[str, str, str, Any], int],
+                answer_path: Optional[str] = None, debug_path: Optional[str] = None,
+                prepare: Optional[Callable[[Doc], Any]] = None,
+                preprocess: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+                chunksize: int = CHUNK_SIZE, batch_size: int = BATCH_SIZE, n_process: int = N_PROCESS,
+                cache=None, stats: Optional[Stats] = None, checkpoint_path: Optional[str] = None,
+                resume: bool = False, memo=None) -> Counter:
+    '''
+    Label the CSV at path window by window (see ReadWindows) with LabelRows,
+    appending "id,label" rows to answer_path (and every column plus the
+    label to debug_path) as each window completes. Only one window is held
+    in memory; use a bounded cache (ex: DocCache) to reuse the Docs of
+    sentences that come back in later windows.
+
+    If checkpoint_path is given, a checkpoint (rows done, last id, label
+    counts and the size of the outputs, which hold the partial labels) is
+    saved after every window and removed when the file is done. With resume,
+    the outputs are cut back to the checkpoint and labeling continues after
+    its last row, so completed sentences are not parsed again.
+    memo is the label cache given to LabelRows.
+
+    Return the count of each label.
+
+    Example
+    ---------
+    >>> LabelStream("data.csv", NLP, RulesCheck, "answer.csv", preprocess=preprocessCSV,
+    ...             cache=DocCache(NLP, STREAM_CACHE_SIZE), checkpoint_path="answer.csv.ckpt", resume=True)
+    Counter({0: 1602, 1: 872})
+    '''
+    state = LoadCheckpoint(checkpoint_path) if resume and checkpoint_path is not None else None
+    if state is not None:
+        assert state["input"] == os.path.abspath(path), "checkpoint was made for {}".format(state["input"])
+        for output, size in ((answer_path, state["answer_size"]), (debug_path, state["debug_size"])):
+            if output is not None:
+                assert size is not None and _output_size(output) is not None and _output_size(output) >= size, \
+                    "{} does not match the checkpoint".format(output)
+                with open(output, "r+b") as f:
+                    f.truncate(size)
+        done = state["rows_done"]
+        counts: Counter = Counter({int(label): n for label, n in state["counts"].items()})
+        logger.info("Resuming after row %d (id %s)", done, state["last_id"])
+    else:
+        for output in (answer_path, debug_path):
+            if output is not None and os.path.exists(output):
+                os.remove(output)
+        done = 0
+        counts = Counter()
+    for window in ReadWindows(path, chunksize, skip=done):
+        window = window.reset_index(drop=True)
+        if preprocess is not None:
+            window = preprocess(window)
+        labels = LabelRows(window, nlp, judge, prepare, batch_size=batch_size,
+                           n_process=n_process, cache=cache, stats=stats, memo=memo)
+        window["label"] = labels
+        if answer_path is not None:
+            AppendCSV(window[["id", "label"]], answer_path, header=done == 0)
+        if debug_path is not None:
+            AppendCSV(window, debug_path, header=done == 0)
+        counts.update(labels)
+        done += len(window)
+        logger.info("Labeled %d rows", done)
+        if checkpoint_path is not None:
+            SaveCheckpoint(checkpoint_path, {
+                "input": os.path.abspath(path),
+                "rows_done": done,
+                "last_id": window["id"].iloc[-1:].tolist()[0],
+                "counts": {str(label): n for label, n in counts.items()},
+                "answer_size": _output_size(answer_path),
+                "debug_size": _output_size(debug_path),
+            })
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return counts
+
+
+def LabelCSV(judge: Callable[[str, str, str, Any], int], prepare: Optional[Callable[[Doc], Any]] = None,
+             memo: Optional[Callable[[str], Any]] = None, stats: Optional[Stats] = None,
+             input_path: str = "data.csv", output_path: str = "answer.csv", debug_dir: Optional[str] = "debug",
+             answers: bool = True, model: Optional[str] = None, batch_size: int = BATCH_SIZE,
+             n_process: int = N_PROCESS, cache_dir: str = STORE_DIR, n_workers: int = 1, stream: bool = False,
+             chunksize: int = CHUNK_SIZE, resume: bool = False, model_workers: int = 0,
+             pool_kind: str = "thread") -> Counter:
+    '''
+    Label input_path with judge (and prepare, see LabelRows), parsing with
+    the model of the engine module which defines judge (its NLP, switched
+    to model if given). The answers (id, label) are written to output_path
+    unless answers is False, and every column with the label to debug_dir
+    (None to skip).
+
+    Parameters
+    ----------
+    memo: called with cache_dir once the model is set, returns the label
+        cache given to LabelRows (closed at the end)
+    stats: Stats of every stage, the caller dumps it
+    n_workers > 1: LabelSharded with that many worker processes
+    stream: read input_path chunksize rows at a time and append the labels
+        as each window completes (see LabelStream). It checkpoints after
+        every window; resume continues an interrupted run from its
+        checkpoint (and implies stream).
+    model_workers > 0: parse with a ModelPool of that many model
+        instances (pool_kind "thread" or "process") in this process
+
+    Return the count of each label.
+
+    Example
+    ---------
+    >>> LabelCSV(RulesCheck, memo=OpenLabelStore, n_workers=4, output_path="answer.csv")
+    Counter({0: 1602, 1: 872})
+    >>> LabelCSV(CompareSimilarity, prepare=IndexSVO, stream=True)
+    '''
+    engine = judge.__module__
+    if model is not None:
+        UseModel(engine, model)
+    nlp = importlib.import_module(engine).NLP
+    stats = stats if stats is not None else Stats()
+    label_cache = memo(cache_dir) if memo is not None else None
+    # model_workers instances of the model parse the batches concurrently (see ModelPool)
+    parser = ModelPool(nlp, model_workers, pool_kind) if model_workers > 0 else nlp
+    debug_path = None
+    if debug_dir is not None:
+        os.makedirs(debug_dir, exist_ok=True)
+        debug_path = os.path.join(debug_dir, os.path.basename(output_path))
+    try:
+        # each distinct sentence is parsed once, in nlp.pipe batches, and only
+        # if it is missing from the parse store; recent Docs are kept in memory
+        # in front of it (sentences come back across the windows of a stream)
+        # Docs of a process pool are loaded into its blank vocab, so are the stored ones
+        vocab = parser.vocab if model_workers > 0 and pool_kind == "process" else None
+        store = DocStore(cache_dir, nlp, vocab=vocab)
+        cache = DocCache(nlp, STREAM_CACHE_SIZE, store=store)
+        if stream or resume:
+            counts = LabelStream(input_path, parser, judge, answer_path=output_path if answers else None,
+                                 debug_path=debug_path, prepare=prepare, preprocess=preprocessCSV,
+                                 chunksize=chunksize, batch_size=batch_size, n_process=n_process,
+                                 cache=cache, stats=stats, checkpoint_path=output_path + CHECKPOINT_SUFFIX,
+                                 resume=resume, memo=label_cache)
+        else:
+            import pandas as pd
+            with stats.timer("read_csv"):
+                df = pd.read_csv(input_path)
+            with stats.timer("preprocess"):
+                df = preprocessCSV(df)
+            if n_workers > 1:
+                # one model per worker process, shards are split by sentence
+                labels = LabelSharded(df, functools.partial(LoadModel, engine, nlp.name), judge, prepare,
+                                      n_workers=n_workers, batch_size=batch_size, cache_dir=cache_dir,
+                                      stats=stats, memo=label_cache, store=store)
+            else:
+                labels = LabelRows(df, parser, judge, prepare, batch_size=batch_size, n_process=n_process,
+                                   cache=cache, stats=stats, memo=label_cache)
+        stats.count("store_hits", store.hits)
+        stats.count("store_misses", store.misses)
+        with stats.timer("store_save"):
+            store.save()
+    finally:
+        if parser is not nlp:
+            parser.close()
+        if label_cache is not None:
+            label_cache.close()
+    if stream or resume:
+        return counts
+    with stats.timer("write_csv"):
+        df["label"] = labels
+        if debug_path is not None:
+            df.to_csv(debug_path, index=False)
+        if answers:
+            df[["id", "label"]].to_csv(output_path, index=False)
+    return Counter(labels)
@@ -3,12 +3,26 @@
 # HW ID: hw2
 # Due Date: 01/30/2022
 
-from typing import List, Tuple, Union
-import pandas as pd
-import spacy
-from spacy import tokens
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING, List, Tuple, Union
+
+from labeling import BATCH_SIZE, N_PROCESS, LabelRows
+from models import LazyModel
+from substring import AhoCorasick
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from spacy import tokens
+
+logger = logging.getLogger(__name__)
+
+# Token attributes read by FindSVO (no NER, no lemmas)
+FINDSVO_ATTRIBUTES = {"text", "pos_", "dep_", "lefts", "rights", "sents"}
+
+NLP = LazyModel("en_core_web_sm", attrs=FINDSVO_ATTRIBUTES)
 
-NLP = spacy.load("en_core_web_sm")
 
 # https://blog.csdn.net/u010087338/article/details/121055591
 OBJECT_DEPS = {"dobj", "attr", "dative", "oprd"}
@@ -18,6 +32,7 @@ VERB_POS = {"AUX", "VERB"}  # is has will should
 
 
 def readCSV(path: str) -> pd.DataFrame:
+    import pandas as pd
     df = pd.read_csv(path)
     return df
 
@@ -101,37 +116,64 @@ def FindSVO(doc: tokens.doc.Doc) -> List[Tuple[str, str, str]]:
     return result
 
 
-def Judge(pred:Tuple[str,str,str], actuals:List[Tuple[str,str,str]])->int:
-    for actual in actuals:
-        same = True
-        for i in range(3):
-            # if len(actual[i])>0:
-            print("Compare => pred:{:25s} actual:{:25s}".format(pred[i],actual[i]))
-            if actual[i] not in pred[i]:
-                same = False
-        print("Result: {}".format(same))
-        print()
-        if same: return 1
-    return 0
+class CandidateMatcher:
+    '''
+    FindSVO candidates of one sentence, with an AhoCorasick automaton per
+    slot (S, V, O) over the candidate strings. matches(pred) finds in one
+    pass over each given string the candidates contained in it.
+    '''
+
+    def __init__(self, actuals: List[Tuple[str, str, str]]):
+        self.actuals = list(actuals)
+        self.slots = [AhoCorasick([actual[i] for actual in self.actuals]) for i in range(3)]
+
+    def matches(self, pred: Tuple[str, str, str]) -> int:
+        '''
+        Bitmask of the candidates whose S, V and O are all in the given ones
+        '''
+        mask = self.slots[0].contained_in(pred[0])
+        if mask:
+            mask &= self.slots[1].contained_in(pred[1])
+        if mask:
+            mask &= self.slots[2].contained_in(pred[2])
+        return mask
 
 
-def Parsing(df: pd.DataFrame, output_path: str, dry_run: bool=True):
+def MatchSVO(doc: tokens.doc.Doc) -> CandidateMatcher:
+    '''
+    FindSVO and index the candidates (the prepare step of Judge)
+    '''
+    return CandidateMatcher(FindSVO(doc))
+
+
+def Judge(pred:Tuple[str,str,str], actuals:Union[CandidateMatcher, List[Tuple[str,str,str]]])->int:
+    '''
+    1 if some candidate has its S, V and O contained in the given ones
+    '''
+    matcher = actuals if isinstance(actuals, CandidateMatcher) else CandidateMatcher(actuals)
+    mask = matcher.matches(pred)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("pred: %s matched: %s", pred,
+                     [actual for k, actual in enumerate(matcher.actuals) if mask >> k & 1])
+    return int(mask != 0)
+
+
+def Parsing(df: pd.DataFrame, output_path: str, dry_run: bool=True,
+            batch_size: int = BATCH_SIZE, n_process: int = N_PROCESS):
     assert output_path.find(".csv")!=-1, "output path should be csv file"
-    column_id = []
-    column_label = []
-    for i in range(len(df)):
-        id = int(df.iloc[i, 0])
-        pred = df.iloc[i,[1,2,3,]]
-        sent = NLP(str(df.iloc[i,4]))
-        actuals = FindSVO(sent)
-        # Judge
+
+    def judge(S: str, V: str, O: str, actuals: CandidateMatcher) -> int:
         if(dry_run): print("=================================START===============================")
-        if(dry_run): print(sent)
-        ok = Judge(pred, actuals)
-        column_id.append(id)
-        column_label.append(ok)
+        ok = Judge((S, V, O), actuals)
         if(dry_run): print("=================================END({})===============================".format(ok),end="\n\n")
+        return ok
+
+    # FindSVO (and its matcher) runs once per distinct sentence, parsed in nlp.pipe batches
+    column_label = LabelRows(df, NLP, judge, prepare=MatchSVO,
+                             batch_size=batch_size, n_process=n_process)
+    column_id = [int(x) for x in df["id"]]
     if not dry_run:
+        import pandas as pd
         # export to csv
         pd.DataFrame({
             "id": column_id,
@@ -3,13 +3,23 @@
 # HW ID: hw2
 # Due Date: 01/30/2022
 
+from __future__ import annotations
+
 from operator import index
-from typing import List, Tuple, Union
-import pandas as pd
-import spacy
-from spacy import tokens
+from typing import TYPE_CHECKING, List, Tuple, Union
+
+from labeling import BATCH_SIZE, N_PROCESS, LabelRows
+from models import LazyModel
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from spacy import tokens
+
+# Token attributes read by Judge, only the parser is needed
+JUDGE_ATTRIBUTES = {"text", "dep_", "head"}
+
+NLP = LazyModel("en_core_web_sm", attrs=JUDGE_ATTRIBUTES)
 
-NLP = spacy.load("en_core_web_sm")
 
 # https://blog.csdn.net/u010087338/article/details/121055591
 OBJECT_DEPS = {"dobj", "attr", "dative", "oprd"}
@@ -19,12 +29,12 @@ VERB_POS = {"AUX", "VERB"}  # is has will should
 
 
 def readCSV(path: str) -> pd.DataFrame:
+    import pandas as pd
     df = pd.read_csv(path)
     return df
 
 
-def Judge(S:str, V:str, O:str, sent: str)->int:
-    doc = NLP(sent)
+def JudgeDoc(S:str, V:str, O:str, doc: tokens.doc.Doc)->int:
     objExist = False
     subExist = False
     for token in doc:
@@ -38,15 +48,16 @@ def Judge(S:str, V:str, O:str, sent: str)->int:
         return 0
 
 
-def Parsing(df: pd.DataFrame):
-    labels = []
-    for i in range(len(df)):
-        S,V,O,sent = df.iloc[i,1],df.iloc[i,2],df.iloc[i,3],df.iloc[i,4]
-        label = Judge(str(S),str(V),str(O),sent)
-        labels.append(label)        
+def Judge(S:str, V:str, O:str, sent: str)->int:
+    return JudgeDoc(S, V, O, NLP(sent))
+
+
+def Parsing(df: pd.DataFrame, batch_size: int = BATCH_SIZE, n_process: int = N_PROCESS,
+            output_path: str = "answer.csv"):
+    labels = LabelRows(df, NLP, JudgeDoc, batch_size=batch_size, n_process=n_process)
     df["label"] = labels
     answer = df[["id","label"]]
-    answer.to_csv("answer.csv",index=False)
+    answer.to_csv(output_path,index=False)
 
 
 
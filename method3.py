@@ -8,20 +8,44 @@ Paper Reference:
 https://www.researchgate.net/publication/228905420_Triplet_extraction_from_sentences
 '''
 
-import re
-from typing import List, Literal, Set, Tuple, Union
-import pandas as pd
-import spacy
-from spacy.tokens.doc import Doc
-from spacy.tokens.span import Span
-from spacy.tokens import Token
-
+from __future__ import annotations
+
+import itertools
+import logging
+from collections import Counter
+from typing import TYPE_CHECKING, Dict, FrozenSet, Hashable, Iterable, Iterator, List, Literal, Optional, Set, Tuple, Union
+from decision_log import SetupLogging
+from instrument import Stats
+from labeling import LabelCSV
+from models import SIMILARITY_ATTRIBUTES, LazyModel
+from parse_cache import PhraseVectors
+from substring import SubstringIndex
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from spacy.tokens import Token
+    from spacy.tokens.doc import Doc
+    from spacy.tokens.span import Span
+
+# Log every step of SVOParse (DEBUG level) and write the debug CSV in main()
 DEBUGMODE = False
 
+logger = logging.getLogger(__name__)
+
 SUBJECT_DEPS = {"nsubj", "nsubjpass", "csubj", "csubjpass", "agent", "expl"}
 OBJECTS_DEPS = {"dobj", "dative", "attr", "oprd", "pobj"}
 
-NLP = spacy.load("en_core_web_trf")
+NLP = LazyModel("en_core_web_trf", attrs=SIMILARITY_ATTRIBUTES)
+# Parsed S/V/O phrases (and their vectors) shared by every CompareSimilarity call
+PHRASES = PhraseVectors(NLP)
+
+# How many CompareSimilarity calls each stage of the cascade decided
+CASCADE_COUNTS = Counter()
+SLOT_STAGES = ("subject_vector", "verb_vector", "object_vector")
+# Longest chain of continuous verbs / expanded children followed by SVOParse
+MAX_TREE_DEPTH = 64
+# Given verbs with more words are matched by scanning the verb sets instead of enumerating subsets
+MAX_SUBSET_WORDS = 8
 
 
 class Color:
@@ -34,7 +58,8 @@ class Color:
 
 def log(*args, **kwargs):
     '''
-    print colorize debug log.
+    colorize debug log, sent to the method3 logger at DEBUG level.
+    Nothing is formatted unless DEBUG is enabled (DEBUGMODE does it in main).
 
     colorset:
         - yellow: yellow, warning (default)
@@ -45,28 +70,29 @@ def log(*args, **kwargs):
     ---------
     >>> log("a","b","c", color='danger')
     '''
-    if DEBUGMODE:
-        color = ""
-        tag = ""
-        if "color" in kwargs and isinstance(kwargs["color"], str):
-            kc = kwargs["color"].lower()
-            if kc in ["yellow", "warning"]:
-                color = Color.YELLOW
-                tag = "WARN"
-            elif kc in ["red", "error", "danger"]:
-                color = Color.RED
-                tag = "ERROR"
-            elif kc in ["blue", "info"]:
-                color = Color.BLUE
-                tag = "INFO"
-            elif kc in ["success", "ok", "green"]:
-                color = Color.GREEN
-                tag = "PASS"
-        else:
-            tag = "WARN"
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    color = ""
+    tag = ""
+    if "color" in kwargs and isinstance(kwargs["color"], str):
+        kc = kwargs["color"].lower()
+        if kc in ["yellow", "warning"]:
             color = Color.YELLOW
-        args_str = ' '.join(map(str, args))
-        print("{}[{}] {}{}".format(color, tag, args_str, Color.RESET))
+            tag = "WARN"
+        elif kc in ["red", "error", "danger"]:
+            color = Color.RED
+            tag = "ERROR"
+        elif kc in ["blue", "info"]:
+            color = Color.BLUE
+            tag = "INFO"
+        elif kc in ["success", "ok", "green"]:
+            color = Color.GREEN
+            tag = "PASS"
+    else:
+        tag = "WARN"
+        color = Color.YELLOW
+    args_str = ' '.join(map(str, args))
+    logger.debug("%s[%s] %s%s", color, tag, args_str, Color.RESET)
 
 
 def show_tree(doc: Doc):
@@ -102,8 +128,11 @@ def FindVerb(token: Token) -> List[Token]:
     return verbs
 
 
-def FindContinuosVerb(verb: Token) -> Token:
+def FindContinuosVerb(verb: Token, max_depth: int = MAX_TREE_DEPTH) -> Token:
     '''
+    Follow the continuous verbs on the right side of verb (at most max_depth
+    of them), return the last one
+
     Example
     --------
     I am considering selling the house.
@@ -114,17 +143,26 @@ def FindContinuosVerb(verb: Token) -> Token:
     for verb "plan"
     we have to return "make"
     '''
-    rights = list(verb.rights)
-    for child in rights:
-        if child.pos_ == "VERB" and child.dep_ == "xcomp":
-            return FindContinuosVerb(child)
+    visited = {verb.i}
+    for _ in range(max_depth):
+        rights = list(verb.rights)
+        following = None
+        for child in rights:
+            if child.pos_ == "VERB" and child.dep_ == "xcomp":
+                following = child
+                break
 
-    # VERB + CCONJ + VERB
-    if len(rights) > 1 and rights[0].pos_ == 'CCONJ':
-        for r in rights[1:]:
-            if is_verb(r):
-                return FindContinuosVerb(r)
+        # VERB + CCONJ + VERB
+        if following is None and len(rights) > 1 and rights[0].pos_ == 'CCONJ':
+            for r in rights[1:]:
+                if is_verb(r):
+                    following = r
+                    break
 
+        if following is None or following.i in visited:
+            break
+        visited.add(following.i)
+        verb = following
     return verb
 
 
@@ -321,46 +359,114 @@ def FindObjects(verb: Token) -> List[Token]:
     return objs
 
 
-def Expand(item: Token, sentence: Span, visited: Set) -> List[Token]:
+def Expand(item: Token, sentence: Span, visited: Set, max_depth: int = MAX_TREE_DEPTH) -> List[Token]:
     '''
     expand an object/subject in doc tree.
     A complete dispict of the subject or object must read in the order of (left, root, right).
-    So I implement an inorder traversal of the tokenized tree.
+    So I implement an inorder traversal of the tokenized tree, with a worklist
+    instead of recursion: ("expand", token) pushes the left children and then
+    ("emit", token), which appends the token and its right children. Children
+    more than max_depth levels below item are not expanded.
     '''
 
     parts = []
-
-    for l in item.lefts:
-        if l.pos_ in {"CCONJ", "VERB"}:
-            break
-        element = Expand(l, sentence, visited)
-        parts.extend(element)
-
-    parts.append(item)
-
-    for r in item.rights:
-        if r.pos_ in {"CCONJ", "VERB"}:
-            break
-        parts.append(r)
-
-    if len(parts) > 0:
-        if hasattr(parts[-1], 'rights'):
-            for x in parts[-1].rights:
-                if x.pos_ == "DET" or x.pos_ in {"NOUN", "PRON"}:
-                    if x.i not in visited:
-                        visited.add(x.i)
-                        parts.extend(Expand(x, sentence, visited))
+    work = [("expand", item, 0)]
+    while len(work) > 0:
+        step, token, depth = work.pop()
+        if step == "expand":
+            work.append(("emit", token, depth))
+            if depth < max_depth:
+                lefts = list(itertools.takewhile(lambda l: l.pos_ not in {"CCONJ", "VERB"}, token.lefts))
+                work.extend(("expand", l, depth + 1) for l in reversed(lefts))
+            continue
+
+        parts.append(token)
+        for r in token.rights:
+            if r.pos_ in {"CCONJ", "VERB"}:
                 break
+            parts.append(r)
+
+        # the last token of this part continues with its first right child
+        for x in parts[-1].rights:
+            if x.pos_ == "DET" or x.pos_ in {"NOUN", "PRON"}:
+                if x.i not in visited and depth < max_depth:
+                    visited.add(x.i)
+                    work.append(("expand", x, depth + 1))
+            break
     return parts
 
 
-def JoinTokens(tokens: List[Token]) -> str:
+def JoinTokens(tokens: Iterable[Token]) -> str:
     return ' '.join([t.text for t in tokens])
 
 
-def SVOParse(doc: Doc):
+class SVOTriple:
+    '''
+    One SVO candidate found by SVOParse, as token indices into its doc: the
+    expanded subject and object (in Expand order) and the verb. The strings
+    (JoinTokens of the tokens) are only built when read, and once per distinct
+    phrase of the doc (texts is shared by the triples of a doc). Indexing and
+    unpacking work like the (S, V, O) tuple of strings.
+
+    Example
+    ---------
+    >>> triple = SVOParse(NLP("he knows the importance ."))[0][0]
+    >>> triple.subject, triple.verb, triple.object
+    ((0,), 1, (2, 3))
+    >>> S, V, O = triple
+    >>> triple[2]
+    'the importance'
+    '''
+
+    __slots__ = ("doc", "subject", "verb", "object", "_texts")
+
+    def __init__(self, doc: Doc, subject: Tuple[int, ...], verb: int, obj: Tuple[int, ...],
+                 texts: Optional[Dict[Tuple[int, ...], str]] = None):
+        self.doc = doc
+        self.subject = subject
+        self.verb = verb
+        self.object = obj
+        self._texts = texts if texts is not None else {}
+
+    def phrase(self, indices: Tuple[int, ...]) -> str:
+        text = self._texts.get(indices)
+        if text is None:
+            text = JoinTokens(self.doc[i] for i in indices)
+            self._texts[indices] = text
+        return text
+
+    def key(self, slot: int) -> Union[int, Tuple[int, ...]]:
+        '''
+        Token indices of a slot, equal for the triples sharing the phrase
+        '''
+        return (self.subject, self.verb, self.object)[slot]
+
+    def __getitem__(self, slot: int) -> str:
+        if slot == 0:
+            return self.phrase(self.subject)
+        if slot == 1:
+            return self.doc[self.verb].text
+        if slot == 2:
+            return self.phrase(self.object)
+        raise IndexError("SVOTriple index out of range")
+
+    def __len__(self) -> int:
+        return 3
+
+    def __iter__(self) -> Iterator[str]:
+        return iter((self[0], self[1], self[2]))
+
+    def __repr__(self) -> str:
+        return "SVOTriple{!r}".format(tuple(self))
+
+
+# A candidate of CandidateIndex / CompareSimilarity, SVOTriple or a tuple of strings
+Candidate = Union[SVOTriple, Tuple[str, str, str]]
+
+
+def SVOParse(doc: Doc) -> List[List[SVOTriple]]:
     '''
-    Find and return SVO triplets. 
+    Find and return SVO triplets (SVOTriple) of each sentence. 
 
     Algorithm
     ----------
@@ -374,6 +480,8 @@ def SVOParse(doc: Doc):
     7. append to svo list
     '''
     svos = []
+    # joined text of each expanded phrase, shared by the triples of the doc
+    texts: Dict[Tuple[int, ...], str] = {}
     for sent in doc.sents:
         svo = []
         verbs = FindVerb(sent)
@@ -388,17 +496,143 @@ def SVOParse(doc: Doc):
             for s in subjects:
                 for o in objects:
                     log("Extract from", s, o, color="\033[92m")
-                    subs = Expand(s, sent, visited)
-                    objs = Expand(o, sent, visited)
+                    subs = tuple(t.i for t in Expand(s, sent, visited))
+                    objs = tuple(t.i for t in Expand(o, sent, visited))
                     if possible_v != v:
-                        svo.append(
-                            (JoinTokens(subs), possible_v.text, JoinTokens(objs)))
-                    svo.append(
-                        (JoinTokens(subs), v.text, JoinTokens(objs)))
+                        svo.append(SVOTriple(doc, subs, possible_v.i, objs, texts))
+                    svo.append(SVOTriple(doc, subs, v.i, objs, texts))
         svos.append(svo)
     return svos
 
 
+class CandidateIndex:
+    '''
+    Index of the SVO candidates of one doc (the output of SVOParse),
+    built once and probed by every row of the sentence:
+        - subjects / objects: SubstringIndex over the distinct subject /
+          object phrases (subobj_check)
+        - verb_sets: distinct verb word sets mapped to the candidates having
+          them; verbs_within enumerates the subsets of the given verb (verb_subset_check)
+    Candidates are grouped by phrase (the token indices of an SVOTriple), and
+    each index is only built, joining its phrases, on the first probe of its slot.
+    Probes return bitmasks of candidates (bit k for solutions[k]) and are
+    memoized by the given string, so rows repeating S, V or O cost a dict lookup.
+
+    Example
+    ---------
+    >>> index = CandidateIndex([[("he", "knows", "the importance")]])
+    >>> index.masks("he", "knows", "importance")
+    (1, 1, 1)
+    '''
+
+    def __init__(self, answerList: List[List[Candidate]]):
+        self.solutions = [solution for sentence in answerList for solution in sentence]
+        # per slot: a candidate having each distinct phrase, and the bitmask of
+        # all the candidates having it
+        self.phrases: List[List[int]] = [[], [], []]
+        self.phrase_masks: List[List[int]] = [[], [], []]
+        for slot in range(3):
+            seen: Dict[Hashable, int] = {}
+            for k, solution in enumerate(self.solutions):
+                key = solution.key(slot) if isinstance(solution, SVOTriple) else solution[slot]
+                p = seen.get(key)
+                if p is None:
+                    seen[key] = len(self.phrases[slot])
+                    self.phrases[slot].append(k)
+                    self.phrase_masks[slot].append(1 << k)
+                else:
+                    self.phrase_masks[slot][p] |= 1 << k
+        self._subjects: Optional[SubstringIndex] = None
+        self._objects: Optional[SubstringIndex] = None
+        self._verb_sets: Optional[Dict[FrozenSet[str], int]] = None
+        self._memo: Dict[Tuple[int, str], int] = {}
+
+    def __len__(self) -> int:
+        return len(self.solutions)
+
+    def texts(self, slot: int) -> List[str]:
+        '''
+        The distinct phrases of a slot, as strings
+        '''
+        return [self.solutions[k][slot] for k in self.phrases[slot]]
+
+    def candidates(self, slot: int, phrases: int) -> int:
+        '''
+        Bitmask of the candidates having one of the phrases (bit p for phrases[slot][p])
+        '''
+        masks = self.phrase_masks[slot]
+        mask = 0
+        while phrases:
+            low = phrases & -phrases
+            mask |= masks[low.bit_length() - 1]
+            phrases ^= low
+        return mask
+
+    @property
+    def subjects(self) -> SubstringIndex:
+        if self._subjects is None:
+            self._subjects = SubstringIndex(self.texts(0))
+        return self._subjects
+
+    @property
+    def objects(self) -> SubstringIndex:
+        if self._objects is None:
+            self._objects = SubstringIndex(self.texts(2))
+        return self._objects
+
+    @property
+    def verb_sets(self) -> Dict[FrozenSet[str], int]:
+        if self._verb_sets is None:
+            self._verb_sets = {}
+            for text, bits in zip(self.texts(1), self.phrase_masks[1]):
+                key = frozenset(text.split())
+                self._verb_sets[key] = self._verb_sets.get(key, 0) | bits
+        return self._verb_sets
+
+    def verbs_within(self, V: str) -> int:
+        '''
+        Bitmask of the candidates whose verb words are all in V
+        '''
+        words = frozenset(V.split())
+        verb_sets = self.verb_sets
+        mask = 0
+        if len(words) <= MAX_SUBSET_WORDS and 2 ** len(words) <= len(verb_sets) * 4:
+            for r in range(len(words) + 1):
+                for subset in itertools.combinations(words, r):
+                    mask |= verb_sets.get(frozenset(subset), 0)
+        else:
+            for key, bits in verb_sets.items():
+                if key <= words:
+                    mask |= bits
+        return mask
+
+    def probe(self, slot: int, text: str) -> int:
+        key = (slot, text)
+        mask = self._memo.get(key)
+        if mask is None:
+            if slot == 0:
+                mask = self.candidates(0, self.subjects.containing(text))
+            elif slot == 1:
+                mask = self.verbs_within(text)
+            else:
+                mask = self.candidates(2, self.objects.containing(text))
+            self._memo[key] = mask
+        return mask
+
+    def masks(self, S: str, V: str, O: str) -> Tuple[int, int, int]:
+        '''
+        Candidates passing subobj_check(S, .), verb_subset_check(V, .) and subobj_check(O, .)
+        '''
+        return self.probe(0, S), self.probe(1, V), self.probe(2, O)
+
+
+def IndexSVO(doc: Doc) -> CandidateIndex:
+    '''
+    SVOParse the doc and index its candidates (the prepare step of CompareSimilarity)
+    '''
+    return CandidateIndex(SVOParse(doc))
+
+
 def verb_validaty_check(V_token: Doc) -> bool:
     '''
     Check the given verb contains noun phrase
@@ -437,49 +671,63 @@ def noun_check(doc: Doc) -> bool:
     return False
 
 
-def CompareSimilarity(S: str, V: str, O: str, answerList: List[List[str]], threshold: float = 0.9) -> Literal[0, 1]:
+def CompareSimilarity(S: str, V: str, O: str, answerList: Union[CandidateIndex, List[List[Candidate]]],
+                      threshold: float = 0.9) -> Literal[0, 1]:
     '''
     Compare similarity
-    '''
-    S_doc = NLP(S)
-    V_doc = NLP(V)
-    O_doc = NLP(O)
 
-    # Check Verb is valid
-    if not verb_validaty_check(V_doc):
-        return 0
+    A candidate matches when each of its S, V, O is similar to the given one
+    (> threshold) or passes the string check (subobj_check, verb_subset_check).
+    answerList is the output of SVOParse or its CandidateIndex (see IndexSVO).
+    The checks run as a cascade, cheapest first:
+        1. the given S/V/O must be valid ("invalid")
+        2. string checks as CandidateIndex probes, any full match returns 1 ("string")
+        3. vector similarity slot by slot (subject, verb, object), only for
+           the slots the string checks left undecided; returns 0 as soon as
+           no candidate is left ("subject_vector", ...) else 1 ("vector")
+    The stage which decided is counted in CASCADE_COUNTS.
+    '''
+    S_doc = PHRASES(S)
+    V_doc = PHRASES(V)
+    O_doc = PHRASES(O)
 
-    if not noun_check(S_doc):
+    # Check Verb is valid
+    if not verb_validaty_check(V_doc) or not noun_check(S_doc) or not noun_check(O_doc):
+        CASCADE_COUNTS["invalid"] += 1
         return 0
 
-    if not noun_check(O_doc):
+    index = answerList if isinstance(answerList, CandidateIndex) else CandidateIndex(answerList)
+    solutions = index.solutions
+    if len(solutions) == 0:
+        CASCADE_COUNTS["empty"] += 1
         return 0
 
-    for sentence in answerList:
-        for solution in sentence:
-            S_check, V_check, O_check = False, False, False
-            S_value = S_doc.similarity(NLP(solution[0]))
-            V_value = V_doc.similarity(NLP(solution[1]))
-            O_value = O_doc.similarity(NLP(solution[2]))
-            # Check Subject
-            if S_value > threshold:
-                S_check = True
-            elif subobj_check(S, solution[0]):
-                S_check = True
-            # Check Verb
-            if V_value > threshold:
-                V_check = True
-            elif verb_subset_check(V, solution[1]):
-                V_check = True
-            # Check Object
-            if O_value > threshold:
-                O_check = True
-            elif subobj_check(O, solution[2]):
-                O_check = True
-            # If three check is passed, return 1
-            if S_check and V_check and O_check:
-                return 1
-    return 0
+    # String checks first, they decide most rows without any vector; a slot
+    # is only probed while some candidate passes the slots before it
+    given = (S, V, O)
+    checks: List[int] = []
+    passing = -1
+    while len(checks) < 3 and passing != 0:
+        checks.append(index.probe(len(checks), given[len(checks)]))
+        passing &= checks[-1]
+    if passing != 0:
+        CASCADE_COUNTS["string"] += 1
+        return 1
+
+    # Vector similarity only for the slots still undecided
+    alive = list(range(len(solutions)))
+    for slot, doc in enumerate((S_doc, V_doc, O_doc)):
+        if slot == len(checks):
+            checks.append(index.probe(slot, given[slot]))
+        undecided = [k for k in alive if not checks[slot] >> k & 1]
+        values = PHRASES.similarity(doc, [solutions[k][slot] for k in undecided])
+        failed = {k for k, value in zip(undecided, values) if not value > threshold}
+        alive = [k for k in alive if k not in failed]
+        if len(alive) == 0:
+            CASCADE_COUNTS[SLOT_STAGES[slot]] += 1
+            return 0
+    CASCADE_COUNTS["vector"] += 1
+    return 1
 
 
 def read_CSV(path: str) -> pd.DataFrame:
@@ -487,49 +735,31 @@ def read_CSV(path: str) -> pd.DataFrame:
     read csv file from given path
     '''
     assert path.find(".csv") != -1, "expected to be csv file"
+    import pandas as pd
     df = pd.read_csv(path)
     return df
 
 
-def removeSign(x: str):
-    '''
-    Remove (` , '',  \") from the original text.
-    '''
-    x1 = re.sub("`+|'{2}|\"", " ", x)
-    x2 = re.sub(' +', ' ', x1)
-    return x2.lower()
-
-
-def preprocessCSV(df: pd.DataFrame):
-    '''
-    Replace bad sign and change to lowercase
-    '''
-    df["S"] = df["S"].apply(removeSign)
-    df["V"] = df["V"].apply(removeSign)
-    df["O"] = df["O"].apply(removeSign)
-    df["sentence"] = df["sentence"].apply(removeSign)
-    return df
-
-
-def main():
-    path = "answer_trf_0413_90_fix.csv"
-    labels = []
-    df = read_CSV("data.csv")
-    df = preprocessCSV(df)
-    for i in range(len(df)):
-        if i % 20 == 0:
-            print("Perform on row {}".format(i))
-        S, V, O, sent = df.iloc[i, 1], df.iloc[i,
-                                               2], df.iloc[i, 3], df.iloc[i, 4]
-        answerList = SVOParse(NLP(str(sent)))
-        label = CompareSimilarity(str(S), str(V), str(O), answerList)
-        labels.append(label)
-    df["label"] = labels
-    if DEBUGMODE:
-        df.to_csv("debug/"+path, index=False)
-    else:
-        answer = df[["id", "label"]]
-        answer.to_csv(path, index=False)
+def main(log_level: str = "INFO", stats_path: str = None, debug: bool = None, debug_dir: str = "debug",
+         output_path: str = "answer_trf_0413_90_fix.csv", **options):
+    '''
+    Label a CSV with CompareSimilarity through labeling.LabelCSV, the options
+    (input_path, model, n_workers, stream, resume, ...) are given to it.
+    In debug mode (default DEBUGMODE) every step is logged and every column
+    with the label is written to debug_dir instead of the answers (id, label)
+    to output_path.
+    '''
+    debug = DEBUGMODE if debug is None else debug
+    SetupLogging("DEBUG" if debug else log_level)
+    stats = Stats()
+    labels = LabelCSV(CompareSimilarity, prepare=IndexSVO, stats=stats, output_path=output_path,
+                      debug_dir=debug_dir if debug else None, answers=not debug, **options)
+    stats.count("phrase_hits", PHRASES.docs.hits)
+    stats.count("phrase_misses", PHRASES.docs.misses)
+    for stage, n in CASCADE_COUNTS.items():
+        stats.count("cascade_" + stage, n)
+    logger.info("Labels: %s", labels)
+    logger.info("Stats: %s", stats.dump(stats_path))
 
 
 if __name__ == "__main__":
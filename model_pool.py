@@ -0,0 +1,155 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Pool of warm model instances for CPU inference.
+
+A single Language object parses on one thread at a time. ModelPool owns
+n_workers instances of the same pipeline and parses batches of sentences
+on them concurrently:
+    - "thread": one instance per thread. PyTorch (en_core_web_trf) and
+      thinc release the GIL in their matrix ops, and the Docs need no copy.
+    - "process": one instance per process, for the CPU-bound Cython
+      pipelines (en_core_web_sm) which hold the GIL. The Docs come back
+      as DocBin bytes (annotations only, no tensor) and are loaded into a
+      blank vocab of the model's language, whose lexical attributes
+      (lower_, is_punct, ...) are set like the model's own.
+submit() returns a Future of the Docs, and blocks (backpressure) when
+max_pending batches are already waiting. pipe() has the signature of
+Language.pipe, so a pool can be given to LabelRows / PipeDocs instead of NLP.
+'''
+
+from __future__ import annotations
+
+import itertools
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, List, Optional, Tuple
+
+from models import LazyModel
+from parse_cache import ModelMeta
+
+if TYPE_CHECKING:
+    from spacy.tokens.doc import Doc
+
+POOL_KINDS = ("thread", "process")
+# Default number of batches waiting per worker before submit() blocks
+PENDING_PER_WORKER = 2
+
+# Model of the current thread (thread pool) or process (process pool)
+_LOCAL = threading.local()
+
+
+def _init_thread(model: LazyModel):
+    _LOCAL.nlp = model.new()
+
+
+def _parse_thread(texts: List[str], batch_size: int) -> List[Doc]:
+    return list(_LOCAL.nlp.pipe(texts, batch_size=batch_size))
+
+
+def _init_process(model: LazyModel):
+    _LOCAL.nlp = model.load()
+
+
+def _parse_process(texts: List[str], batch_size: int) -> bytes:
+    from spacy.tokens import DocBin
+    return DocBin(docs=_LOCAL.nlp.pipe(texts, batch_size=batch_size)).to_bytes()
+
+
+class ModelPool:
+    '''
+    n_workers warm instances of model parsing batches of sentences concurrently
+
+    Example
+    ---------
+    >>> pool = ModelPool(NLP, n_workers=4, kind="thread")
+    >>> docs = pool.submit(["she kissed me .", "he knows it ."]).result()
+    >>> labels = LabelRows(df, pool, RulesCheck)   # pool.pipe instead of NLP.pipe
+    >>> pool.close()
+    '''
+
+    def __init__(self, model: LazyModel, n_workers: int = 2, kind: str = "thread",
+                 max_pending: Optional[int] = None):
+        assert kind in POOL_KINDS, "kind should be one of {}".format(POOL_KINDS)
+        assert n_workers > 0, "n_workers should be positive"
+        self.model = model
+        self.kind = kind
+        self.n_workers = n_workers
+        self.max_pending = max_pending or n_workers * PENDING_PER_WORKER
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        if kind == "thread":
+            self._executor = ThreadPoolExecutor(n_workers, initializer=_init_thread, initargs=(model,))
+        else:
+            self._executor = ProcessPoolExecutor(n_workers, initializer=_init_process, initargs=(model,))
+            # strings of the returned Docs are added to this vocab; a bare Vocab()
+            # has no lexical attribute getters (every lower_ would be "")
+            import spacy
+            self.vocab = spacy.blank(ModelMeta(model.name)["lang"]).vocab
+            self._vocab_lock = threading.Lock()
+
+    def submit(self, sentences: List[str], batch_size: int = 64, block: bool = True,
+               timeout: Optional[float] = None) -> "Future[List[Doc]]":
+        '''
+        Parse sentences on the next free instance. Blocks while max_pending
+        batches are waiting (raises queue.Full if block is False or on timeout).
+        '''
+        if not self._slots.acquire(block, timeout):
+            raise queue.Full("{} batches already pending".format(self.max_pending))
+        sentences = list(sentences)
+        if self.kind == "thread":
+            future = self._executor.submit(_parse_thread, sentences, batch_size)
+        else:
+            future = self._from_bytes(self._executor.submit(_parse_process, sentences, batch_size))
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _from_bytes(self, inner: Future) -> "Future[List[Doc]]":
+        outer: Future = Future()
+
+        def done(f: Future):
+            from spacy.tokens import DocBin
+            try:
+                with self._vocab_lock:
+                    docs = list(DocBin().from_bytes(f.result()).get_docs(self.vocab))
+                outer.set_result(docs)
+            except Exception as e:
+                outer.set_exception(e)
+        inner.add_done_callback(done)
+        return outer
+
+    def pipe(self, texts: Iterable[Any], as_tuples: bool = False, batch_size: int = 64,
+             n_process: int = 1) -> Iterator[Any]:
+        '''
+        Same as Language.pipe, the batches are parsed by the pool (n_process is ignored)
+        '''
+        texts = iter(texts)
+        pending: List[Tuple[list, Future]] = []
+        while True:
+            batch = list(itertools.islice(texts, batch_size))
+            if len(batch) > 0:
+                sentences = [text for text, _ in batch] if as_tuples else batch
+                # keep every instance busy, the oldest batch is yielded first
+                pending.append((batch, self.submit(sentences, batch_size)))
+            if len(pending) == 0:
+                return
+            if len(batch) > 0 and len(pending) < self.max_pending:
+                continue
+            batch_in, future = pending.pop(0)
+            docs = future.result()
+            if as_tuples:
+                yield from zip(docs, (context for _, context in batch_in))
+            else:
+                yield from docs
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,189 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Process-wide registry of spaCy pipelines, loaded on first use.
+
+Importing a module that defines NLP = LazyModel(...) costs nothing; the
+pipeline is only loaded the first time a sentence is parsed (or any other
+attribute of the Language object is used).
+
+Each engine declares the token attributes it reads, and only the
+components that set them are loaded (see ExcludeFor).
+'''
+
+import importlib
+import threading
+from types import ModuleType
+from typing import TYPE_CHECKING, Dict, FrozenSet, Iterable, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    from spacy.language import Language
+
+# Components of the en_core_web_* pipelines which set each token attribute
+ATTRIBUTE_COMPONENTS = {
+    "text": set(),
+    "i": set(),
+    "pos_": {"tagger", "attribute_ruler", "morphologizer"},
+    "tag_": {"tagger"},
+    "morph": {"tagger", "attribute_ruler", "morphologizer"},
+    "lemma_": {"tagger", "attribute_ruler", "lemmatizer"},
+    "dep_": {"parser"},
+    "head": {"parser"},
+    "lefts": {"parser"},
+    "rights": {"parser"},
+    "children": {"parser"},
+    "sents": {"parser", "senter"},
+    "ent_type_": {"ner"},
+    "ents": {"ner"},
+    # Doc.similarity / Doc.vector fall back to the tensor of the embedding layer
+    "vector": set(),
+}
+# Embedding layers shared by the other components, never excluded
+EMBEDDING_COMPONENTS = {"tok2vec", "transformer"}
+# Components that may be excluded when no declared attribute needs them
+PRUNABLE_COMPONENTS = {"tagger", "morphologizer", "attribute_ruler", "lemmatizer", "parser", "senter", "ner"}
+
+# Token attributes read by SVOParse and CompareSimilarity (no NER, no lemmas)
+SIMILARITY_ATTRIBUTES = {"text", "pos_", "tag_", "dep_", "head", "lefts", "rights", "sents", "vector"}
+
+_MODELS: Dict[Tuple[str, FrozenSet[str]], "Language"] = {}
+_LOCK = threading.Lock()
+
+
+def GetModel(name: str, exclude: Iterable[str] = ()) -> "Language":
+    '''
+    Load a pipeline once per process, keyed by model name and the excluded
+    components. Later calls with the same key return the same object.
+    '''
+    key = (name, frozenset(exclude))
+    nlp = _MODELS.get(key)
+    if nlp is None:
+        with _LOCK:
+            nlp = _MODELS.get(key)
+            if nlp is None:
+                import spacy
+                nlp = spacy.load(name, exclude=sorted(key[1]))
+                _MODELS[key] = nlp
+    return nlp
+
+
+def ComponentsFor(attrs: Iterable[str]) -> FrozenSet[str]:
+    '''
+    Components needed to set the given token attributes
+    '''
+    needed = set(EMBEDDING_COMPONENTS)
+    for attr in attrs:
+        assert attr in ATTRIBUTE_COMPONENTS, "unknown token attribute {}".format(attr)
+        needed |= ATTRIBUTE_COMPONENTS[attr]
+    return frozenset(needed)
+
+
+def ExcludeFor(attrs: Iterable[str]) -> FrozenSet[str]:
+    '''
+    Components that can be excluded when only the given attributes are read
+
+    Example
+    ---------
+    >>> sorted(ExcludeFor({"text", "dep_", "head"}))
+    ['attribute_ruler', 'lemmatizer', 'morphologizer', 'ner', 'senter', 'tagger']
+    '''
+    return frozenset(PRUNABLE_COMPONENTS - ComponentsFor(attrs))
+
+
+def IsLoaded(name: str, exclude: Iterable[str] = ()) -> bool:
+    '''
+    Check if a pipeline is already in the registry (without loading it)
+    '''
+    return (name, frozenset(exclude)) in _MODELS
+
+
+class LazyModel:
+    '''
+    Stand-in for a spaCy Language object that loads it from the registry on
+    first use. It can be called and piped like the pipeline itself.
+
+    If attrs is given, every component that does not set one of these token
+    attributes is excluded from the pipeline.
+
+    Example
+    ---------
+    >>> NLP = LazyModel("en_core_web_trf")   # nothing is loaded yet
+    >>> doc = NLP("She kissed and hugged me.")  # loads the model here
+    >>> PARSER = LazyModel("en_core_web_sm", attrs={"text", "dep_", "head"})
+    '''
+
+    def __init__(self, name: str, exclude: Iterable[str] = (), attrs: Iterable[str] = None):
+        self.name = name
+        self.exclude = frozenset(exclude)
+        if attrs is not None:
+            self.exclude |= ExcludeFor(attrs)
+
+    def load(self) -> "Language":
+        return GetModel(self.name, self.exclude)
+
+    def use(self, name: str):
+        '''
+        Switch to the pipeline name, excluding the same components
+        '''
+        self.name = name
+
+    def new(self) -> "Language":
+        '''
+        Load a separate instance of the pipeline (not shared through the registry)
+        '''
+        import spacy
+        return spacy.load(self.name, exclude=sorted(self.exclude))
+
+    @property
+    def loaded(self) -> bool:
+        return IsLoaded(self.name, self.exclude)
+
+    def __call__(self, text: str, **kwargs):
+        return self.load()(text, **kwargs)
+
+    def pipe(self, texts, **kwargs):
+        return self.load().pipe(texts, **kwargs)
+
+    def __getattr__(self, attr: str):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __reduce__(self):
+        # only the name is sent to other processes, they load their own copy
+        return (LazyModel, (self.name, self.exclude))
+
+    def __repr__(self) -> str:
+        return "LazyModel({!r}, loaded={})".format(self.name, self.loaded)
+
+
+def UseModel(engine: Union[str, ModuleType], name: str):
+    '''
+    Switch the model of an engine module (its NLP) to the pipeline name.
+    NLP is switched in place, so everything built on it (ex: method3.PHRASES)
+    follows; call it before the first sentence is parsed.
+
+    Example
+    ---------
+    >>> UseModel(method3, "en_core_web_sm")
+    >>> UseModel("Hw2_0716235", "en_core_web_sm")
+    '''
+    module = importlib.import_module(engine) if isinstance(engine, str) else engine
+    module.NLP.use(name)
+
+
+def LoadModel(engine: str, name: Optional[str] = None) -> "Language":
+    '''
+    Return the model of an engine module (called in each worker process),
+    switching to the model name first if given
+
+    Example
+    ---------
+    >>> load_model = functools.partial(LoadModel, "method3", "en_core_web_sm")
+    '''
+    if name is not None:
+        UseModel(engine, name)
+    return importlib.import_module(engine).NLP.load()
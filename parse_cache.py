@@ -0,0 +1,318 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from models import LazyModel
+
+if TYPE_CHECKING:
+    import numpy as np
+    from spacy.language import Language
+    from spacy.tokens.doc import Doc
+
+# Default directory of the persistent parse store
+STORE_DIR = ".parse_cache"
+# New Docs kept in memory by DocStore before they are appended to disk
+STORE_FLUSH_SIZE = 1024
+# Maximum number of short phrases kept by PhraseVectors
+PHRASE_CACHE_SIZE = 65536
+
+
+class DocCache:
+    '''
+    Bounded LRU cache from (normalized) sentence text to its parsed Doc.
+
+    data.csv has several S/V/O rows for the same sentence, so the model only
+    needs to run once per distinct sentence. The least recently used Doc is
+    dropped when the cache is full.
+    If a store (DocStore) is given, the cache is the in-memory layer in
+    front of it: a Doc missing from the cache is read from the store, and
+    a new Doc is put into both.
+
+    Example
+    ---------
+    >>> parse = DocCache(NLP, maxsize=1024)
+    >>> parse("she kissed and hugged me .") is parse("she kissed and hugged me .")
+    True
+    >>> cache = DocCache(NLP, store=DocStore(".parse_cache", NLP))
+    '''
+
+    def __init__(self, nlp: Callable[[str], Doc], maxsize: int = 4096, store: Optional[DocStore] = None):
+        assert maxsize > 0, "maxsize should be positive"
+        self.nlp = nlp
+        self.maxsize = maxsize
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._docs: "OrderedDict[str, Doc]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __contains__(self, text: str) -> bool:
+        return text in self._docs
+
+    def get(self, text: str):
+        '''
+        Return the cached Doc of text (or None), marking it as recently used.
+        '''
+        doc = self._docs.get(text)
+        if doc is not None:
+            self._docs.move_to_end(text)
+        elif self.store is not None:
+            doc = self.store.get(text)
+            if doc is not None:
+                self._insert(text, doc)
+        return doc
+
+    def put(self, text: str, doc: Doc):
+        '''
+        Insert a Doc (and add it to the store), evicting the least recently used one if full.
+        '''
+        self._insert(text, doc)
+        if self.store is not None:
+            self.store.put(text, doc)
+
+    def _insert(self, text: str, doc: Doc):
+        self._docs[text] = doc
+        self._docs.move_to_end(text)
+        while len(self._docs) > self.maxsize:
+            self._docs.popitem(last=False)
+
+    def __call__(self, text: str) -> Doc:
+        doc = self.get(text)
+        if doc is not None:
+            self.hits += 1
+            return doc
+        self.misses += 1
+        doc = self.nlp(text)
+        self.put(text, doc)
+        return doc
+
+
+class PhraseVectors:
+    '''
+    Cache of parsed S/V/O phrases and their vectors for similarity scoring.
+
+    The same short phrases ("he", "said", "it") come up for almost every
+    candidate triplet, so each distinct phrase is parsed once (misses are
+    parsed together with nlp.pipe) and its Doc, which keeps its own vector,
+    is reused. similarity() scores one phrase against many with a single
+    matrix multiply and gives the same values as Doc.similarity.
+
+    Example
+    ---------
+    >>> phrases = PhraseVectors(NLP)
+    >>> phrases.similarity(phrases("he"), ["he", "the official"])
+    array([1.  , 0.42], dtype=float32)
+    '''
+
+    def __init__(self, nlp: Language, maxsize: int = PHRASE_CACHE_SIZE):
+        self.nlp = nlp
+        self.docs = DocCache(nlp, maxsize)
+
+    def __call__(self, phrase: str) -> Doc:
+        return self.docs(phrase)
+
+    def parse(self, phrases: List[str]) -> List[Doc]:
+        '''
+        Return the Docs of the phrases, parsing the missing ones in one batch
+        '''
+        unique = list(dict.fromkeys(phrases))
+        missing = [p for p in unique if p not in self.docs]
+        self.docs.hits += len(unique) - len(missing)
+        self.docs.misses += len(missing)
+        for p, doc in zip(missing, self.nlp.pipe(missing)):
+            self.docs.put(p, doc)
+        docs = []
+        for p in phrases:
+            doc = self.docs.get(p)
+            # a phrase may be evicted while the others are inserted
+            docs.append(doc if doc is not None else self.nlp(p))
+        return docs
+
+    def similarity(self, doc: Doc, phrases: List[str]) -> np.ndarray:
+        '''
+        Cosine similarity of doc against every phrase, same rules as
+        Doc.similarity: identical tokens give 1, a missing vector gives 0
+        '''
+        import numpy as np
+        from spacy.attrs import ORTH
+        scores = np.zeros(len(phrases), dtype=np.float32)
+        if len(phrases) == 0:
+            return scores
+        unique = list(dict.fromkeys(phrases))
+        others = self.parse(unique)
+        attr = getattr(doc.vocab.vectors, "attr", ORTH)
+        words = tuple(doc.to_array(attr).tolist())
+        values = np.zeros(len(unique), dtype=np.float32)
+        norms = np.array([o.vector_norm for o in others], dtype=np.float32)
+        if doc.vector_norm != 0:
+            matrix = np.stack([o.vector for o in others]).astype(np.float32, copy=False)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = (matrix @ doc.vector) / (doc.vector_norm * norms)
+            values[norms == 0] = 0
+        for k, other in enumerate(others):
+            if len(other) == len(doc) and tuple(other.to_array(attr).tolist()) == words:
+                values[k] = 1.0
+        index = {p: k for k, p in enumerate(unique)}
+        for j, p in enumerate(phrases):
+            scores[j] = values[index[p]]
+        return scores
+
+
+def ModelMeta(name: str) -> Dict[str, Any]:
+    '''
+    meta.json of an installed pipeline package or a pipeline directory
+    '''
+    from spacy import util
+    path = util.get_package_path(name) if util.is_package(name) else Path(name)
+    return util.load_meta(path / "meta.json")
+
+
+def ModelID(nlp: Union[Language, LazyModel]) -> str:
+    '''
+    Name, version and active components of a pipeline,
+    ex: "en_core_web_trf-3.2.0-transformer.tagger.parser.attribute_ruler.ner"
+    A LazyModel which is not loaded yet is described from its meta.json (without loading it).
+    '''
+    if isinstance(nlp, LazyModel) and not nlp.loaded:
+        meta = ModelMeta(nlp.name)
+        skipped = nlp.exclude | set(meta.get("disabled", []))
+        names = [name for name in meta.get("pipeline", []) if name not in skipped]
+    else:
+        meta, names = nlp.meta, nlp.pipe_names
+    return "{}_{}-{}-{}".format(meta.get("lang", ""), meta.get("name", ""), meta.get("version", ""),
+                                ".".join(names))
+
+
+class DocStore:
+    '''
+    Persistent on-disk store of parsed Docs (SQLite table of DocBin bytes).
+
+    Docs are keyed by a hash of the model name, model version, active
+    components and sentence text, and each model gets its own file, so changing the rules
+    never requires parsing data.csv again while changing the model does.
+    A Doc is only read from disk when its sentence is looked up, and new
+    Docs are appended in batches (every flush_size puts and on save()), so
+    memory does not grow with the number of stored sentences.
+
+    A readonly store (one per worker process) never writes: its new Docs are
+    handed over with take_new() and added by the owner of the store with add_new().
+    Stored Docs are loaded into vocab (default nlp.vocab); give the vocab of
+    a process ModelPool so that reading the store does not load the model here.
+
+    Example
+    ---------
+    >>> store = DocStore(".parse_cache", NLP)
+    >>> labels = LabelRows(df, NLP, RulesCheck, cache=store)
+    >>> store.save()
+    '''
+
+    def __init__(self, directory: str, nlp: Language, readonly: bool = False,
+                 flush_size: int = STORE_FLUSH_SIZE, vocab=None):
+        self.model = ModelID(nlp)
+        self.nlp = nlp
+        self._vocab = vocab
+        self.path = os.path.join(directory, self.model + ".sqlite")
+        self.readonly = readonly
+        self.flush_size = flush_size
+        self.hits = 0
+        self.misses = 0
+        self._db: Optional[sqlite3.Connection] = None
+        # key -> DocBin bytes of the Docs not written yet
+        self._pending: Dict[str, bytes] = {}
+
+    @property
+    def vocab(self):
+        return self._vocab if self._vocab is not None else self.nlp.vocab
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # the file is only opened on first use
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS docs (key TEXT PRIMARY KEY, doc BLOB NOT NULL) WITHOUT ROWID")
+        return self._db
+
+    def key(self, text: str) -> str:
+        '''
+        Content hash of the sentence for the store's model
+        '''
+        return hashlib.sha1("{}\0{}".format(self.model, text).encode("utf-8")).hexdigest()
+
+    def _read(self, key: str) -> Optional[bytes]:
+        data = self._pending.get(key)
+        if data is None:
+            row = self.db.execute("SELECT doc FROM docs WHERE key = ?", (key,)).fetchone()
+            data = row[0] if row is not None else None
+        return data
+
+    def __len__(self) -> int:
+        self.save()
+        return self.db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def __contains__(self, text: str) -> bool:
+        return self._read(self.key(text)) is not None
+
+    def get(self, text: str):
+        '''
+        Return the stored Doc of text, or None if it was never parsed
+        '''
+        data = self._read(self.key(text))
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        from spacy.tokens import DocBin
+        return next(DocBin().from_bytes(data).get_docs(self.vocab))
+
+    def put(self, text: str, doc: Doc):
+        from spacy.tokens import DocBin
+        self._pending[self.key(text)] = DocBin(docs=[doc]).to_bytes()
+        if len(self._pending) >= self.flush_size:
+            self.save()
+
+    def take_new(self) -> List[Tuple[str, bytes]]:
+        '''
+        Remove and return the Docs put since the last call, as (key, DocBin bytes)
+        '''
+        items = list(self._pending.items())
+        self._pending.clear()
+        return items
+
+    def add_new(self, items: Iterable[Tuple[str, bytes]]):
+        '''
+        Add Docs returned by take_new() of another store of the same model
+        '''
+        for key, data in items:
+            self._pending[key] = data
+            if len(self._pending) >= self.flush_size:
+                self.save()
+
+    def save(self):
+        '''
+        Append the pending Docs to the store (nothing for a readonly store)
+        '''
+        if self.readonly or len(self._pending) == 0:
+            return
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO docs (key, doc) VALUES (?, ?)", self._pending.items())
+        self._pending.clear()
+
+    def close(self):
+        self.save()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
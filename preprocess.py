@@ -0,0 +1,65 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Text normalization of data.csv, shared by every engine.
+
+Quotes (` '' ") become spaces, repeated spaces are squeezed and the text
+is lowercased. The work is done with pandas string methods on the distinct
+values of all the text columns together, then mapped back to the rows, so
+a sentence repeated by many rows is normalized once.
+'''
+
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+SIGN_PATTERN = re.compile("`+|'{2}|\"")
+SPACES_PATTERN = re.compile(" +")
+TEXT_COLUMNS = ["S", "V", "O", "sentence"]
+
+
+def removeSign(x: str) -> str:
+    '''
+    Remove (` , '',  \") from the original text.
+    '''
+    return SPACES_PATTERN.sub(" ", SIGN_PATTERN.sub(" ", x))
+
+
+def lower(x: str) -> str:
+    '''
+    Transform letter to lower
+    '''
+    return x.lower()
+
+
+def NormalizeText(texts: pd.Series) -> pd.Series:
+    '''
+    removeSign and lower on every value of texts
+
+    Example
+    ---------
+    >>> NormalizeText(pd.Series(["``Hello''  World"])).tolist()
+    [' hello world']
+    '''
+    return (texts.str.replace(SIGN_PATTERN, " ", regex=True)
+                 .str.replace(SPACES_PATTERN, " ", regex=True)
+                 .str.lower())
+
+
+def preprocessCSV(df: pd.DataFrame, columns=TEXT_COLUMNS) -> pd.DataFrame:
+    '''
+    Replace bad sign and change to lowercase (in place, df is also returned)
+    '''
+    import pandas as pd
+    values = pd.unique(df[columns].to_numpy().ravel())
+    normalized = pd.Series(NormalizeText(pd.Series(values, dtype=object)).to_numpy(), index=values)
+    for col in columns:
+        df[col] = df[col].map(normalized)
+    return df
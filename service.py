@@ -0,0 +1,408 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Online labeling service for RulesCheck.
+
+Other services send one (S, V, O, sentence) row per request. Concurrent
+requests are collected into micro-batches (at most max_batch rows, waiting
+at most max_wait_ms after the first one) so each batch of sentences goes
+through NLP.pipe together. Batches are labeled in executor threads (one at
+a time, or one per instance of a ModelPool with --model-workers), the
+event loop keeps accepting requests meanwhile.
+
+Protocol (HTTP/1.1 with keep-alive, over TCP or a Unix socket)
+---------
+POST /label  {"S": "he", "V": "knows", "O": "the importance", "sentence": "...", "explain": true}
+          -> {"label": 1, "reasons": [["ALIGNMENT", [8], [9], [11, 12]], ["SUBJ_DIRECT", 8, 9], ...]}
+GET /health  -> {"status": "ok"}
+
+Example
+---------
+$ python service.py serve --port 8080 --max-batch 32 --max-wait-ms 5
+$ python service.py load --port 8080 --requests 2000 --concurrency 64
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+import Hw2_0716235 as rules
+from decision_log import SetupLogging
+from instrument import Stats
+from labeling import GroupRowsBySentence
+from model_pool import ModelPool
+from models import UseModel
+from parse_cache import DocCache
+from preprocess import preprocessCSV
+
+logger = logging.getLogger(__name__)
+
+HOST = "127.0.0.1"
+PORT = 8080
+# Largest number of rows labeled together
+MAX_BATCH = 32
+# Longest wait for more rows once a batch has its first one
+MAX_WAIT_MS = 5.0
+# Requests waiting for a batch before submit() blocks
+MAX_QUEUE = 1024
+# Docs of recent sentences kept by the service
+SERVICE_CACHE_SIZE = 4096
+# Largest request head (StreamReader limit) and body, a row is a few hundred bytes
+MAX_HEAD = 1 << 16
+MAX_BODY = 1 << 20
+FIELDS = ("S", "V", "O", "sentence")
+
+DOCS: Optional[DocCache] = None
+_LOCK = threading.Lock()
+# Parses the sentences of a batch, rules.NLP unless a ModelPool is used
+PARSER = None
+
+
+def LabelBatch(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Label request rows with RulesCheck, parsing their distinct sentences in one
+    nlp.pipe call. Rows with "explain" get the reason codes of the decision.
+
+    Several batches may run at once (with a ModelPool): only the parse runs
+    concurrently, the Doc cache and the rules (global trace) are behind _LOCK.
+    '''
+    global DOCS
+    df = preprocessCSV(pd.DataFrame([[str(row[field]) for field in FIELDS] for row in rows], columns=FIELDS))
+    S, V, O = df["S"].tolist(), df["V"].tolist(), df["O"].tolist()
+    groups = GroupRowsBySentence(df["sentence"])
+    with _LOCK:
+        if DOCS is None or DOCS.nlp is not rules.NLP:
+            DOCS = DocCache(rules.NLP, SERVICE_CACHE_SIZE)
+        docs = {text: DOCS.get(text) for text in groups}
+    missing = [text for text, doc in docs.items() if doc is None]
+    parsed = list((PARSER or rules.NLP).pipe(missing)) if len(missing) > 0 else []
+    explain = any(row.get("explain") for row in rows)
+    results: List[Dict[str, Any]] = [{} for _ in rows]
+    with _LOCK:
+        for text, doc in zip(missing, parsed):
+            DOCS.put(text, doc)
+            docs[text] = doc
+        if explain:
+            trace = rules.EnableTrace()
+        try:
+            for text, indices in groups.items():
+                for i in indices:
+                    results[i]["label"] = int(rules.RulesCheck(S[i], V[i], O[i], docs[text]))
+                    if rows[i].get("explain"):
+                        results[i]["reasons"] = trace.records[-1]["events"]
+        finally:
+            if explain:
+                rules.DisableTrace()
+    return results
+
+
+class MicroBatcher:
+    '''
+    Collect concurrent submit() calls into batches for handler, which is
+    called in executor with the list of items and returns one result per item.
+    At most concurrency batches run at once. submit() waits when max_queue
+    items are already pending (backpressure).
+
+    Example
+    ---------
+    >>> batcher = MicroBatcher(LabelBatch, max_batch=32, max_wait_ms=5)
+    >>> batcher.start()
+    >>> await batcher.submit({"S": "she", "V": "kissed", "O": "me", "sentence": "she kissed me ."})
+    {'label': 1}
+    '''
+
+    def __init__(self, handler: Callable[[List[Any]], List[Any]], max_batch: int = MAX_BATCH,
+                 max_wait_ms: float = MAX_WAIT_MS, max_queue: int = MAX_QUEUE,
+                 executor: Optional[Executor] = None, concurrency: int = 1):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.executor = executor or ThreadPoolExecutor(max_workers=concurrency)
+        self.batches = 0
+        self.items = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running: set = set()
+
+    def start(self):
+        self._queue = asyncio.Queue(self.max_queue)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, item: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[Any, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            # wait for a free worker first, the next batch keeps filling meanwhile
+            await slots.acquire()
+            batch = await self._next_batch()
+            task = asyncio.get_running_loop().create_task(self._label(batch))
+            self._running.add(task)
+            task.add_done_callback(lambda t: (self._running.discard(t), slots.release()))
+
+    async def _label(self, batch: List[Tuple[Any, asyncio.Future]]):
+        items = [item for item, _ in batch]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self.handler, items)
+        except Exception as e:
+            logger.exception("Batch of %d failed", len(items))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(items)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+def _response(status: str, body: Dict[str, Any]) -> bytes:
+    data = json.dumps(body).encode("utf-8")
+    head = "HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(status, len(data))
+    return head.encode("ascii") + data
+
+
+class RequestError(Exception):
+    '''
+    Malformed request, answered with status and then the connection is closed
+    '''
+
+    def __init__(self, status: str, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, bytes]]:
+    '''
+    Read one HTTP request, return (method, path, body) or None when the client is gone.
+    Raise RequestError for a request which cannot be read.
+    '''
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise RequestError("413 Payload Too Large", "headers longer than {} bytes".format(MAX_HEAD))
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, path, _ = lines[0].split(" ", 2)
+        length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value.strip())
+    except ValueError:
+        raise RequestError("400 Bad Request", "malformed request line or Content-Length")
+    if length > MAX_BODY:
+        raise RequestError("413 Payload Too Large", "body longer than {} bytes".format(MAX_BODY))
+    try:
+        body = await reader.readexactly(length) if length > 0 else b""
+    except asyncio.IncompleteReadError as e:
+        raise RequestError("400 Bad Request", "body of {} bytes, Content-Length is {}".format(
+            len(e.partial), length))
+    return method, path, body
+
+
+class LabelService:
+    '''
+    HTTP front end of a MicroBatcher running LabelBatch
+    '''
+
+    def __init__(self, batcher: MicroBatcher):
+        self.batcher = batcher
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except RequestError as e:
+                    # the rest of the stream cannot be trusted, answer and close
+                    writer.write(_response(e.status, {"error": str(e)}))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                writer.write(await self.respond(*request))
+                await writer.drain()
+        except ConnectionError as e:
+            logger.debug("Connection closed: %s", e)
+        finally:
+            writer.close()
+
+    async def respond(self, method: str, path: str, body: bytes) -> bytes:
+        if method == "GET" and path == "/health":
+            return _response("200 OK", {"status": "ok", "batches": self.batcher.batches,
+                                        "rows": self.batcher.items})
+        if method != "POST" or path != "/label":
+            return _response("404 Not Found", {"error": "unknown endpoint {} {}".format(method, path)})
+        try:
+            row = json.loads(body)
+        except ValueError:
+            row = None
+        # a bad row would fail the whole micro-batch it joins, so it is rejected here
+        if not isinstance(row, dict):
+            return _response("400 Bad Request", {"error": "body should be a JSON object"})
+        missing = [field for field in FIELDS if field not in row]
+        if len(missing) > 0:
+            return _response("400 Bad Request", {"error": "missing fields {}".format(missing)})
+        try:
+            result = await self.batcher.submit(row)
+        except Exception as e:
+            return _response("500 Internal Server Error", {"error": str(e)})
+        return _response("200 OK", result)
+
+
+async def Serve(host: str = HOST, port: int = PORT, unix_path: Optional[str] = None,
+                max_batch: int = MAX_BATCH, max_wait_ms: float = MAX_WAIT_MS, model_workers: int = 0):
+    '''
+    Run the service until cancelled, on host:port or on the Unix socket unix_path.
+    With model_workers > 0, several batches are labeled at once and their
+    sentences are parsed by a ModelPool of that many model instances.
+    '''
+    global PARSER
+    rules.NLP.load()
+    if model_workers > 0:
+        PARSER = ModelPool(rules.NLP, model_workers)
+    batcher = MicroBatcher(LabelBatch, max_batch, max_wait_ms, concurrency=max(1, model_workers))
+    batcher.start()
+    service = LabelService(batcher)
+    if unix_path is not None:
+        server = await asyncio.start_unix_server(service.handle, unix_path, limit=MAX_HEAD)
+    else:
+        server = await asyncio.start_server(service.handle, host, port, limit=MAX_HEAD)
+    logger.info("Serving on %s", unix_path or "{}:{}".format(host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+        if PARSER is not None:
+            PARSER.close()
+
+
+async def _client(rows: List[Dict[str, Any]], host: str, port: int, unix_path: Optional[str],
+                  stats: Stats, labels: List[Optional[int]]):
+    if unix_path is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i, row in rows:
+            data = json.dumps(row).encode("utf-8")
+            start = time.perf_counter()
+            writer.write("POST /label HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\n"
+                         "Content-Length: {}\r\n\r\n".format(host, len(data)).encode("ascii") + data)
+            await writer.drain()
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = int(head.decode("latin-1").lower().split("content-length:")[1].split("\r\n")[0])
+            body = json.loads(await reader.readexactly(length))
+            stats.add_time("request", time.perf_counter() - start)
+            labels[i] = body.get("label")
+            stats.count("errors" if "error" in body else "rows")
+    finally:
+        writer.close()
+
+
+async def LoadTest(csv_path: str = "data.csv", n_requests: int = 2000, concurrency: int = 64,
+                   host: str = HOST, port: int = PORT, unix_path: Optional[str] = None) -> Dict[str, Any]:
+    '''
+    Send n_requests rows of csv_path from concurrency connections and return
+    the throughput and latency percentiles (and the labels)
+    '''
+    df = pd.read_csv(csv_path)
+    records = df[list(FIELDS)].astype(str).to_dict("records")
+    rows = [(i, records[i % len(records)]) for i in range(n_requests)]
+    stats = Stats()
+    labels: List[Optional[int]] = [None] * n_requests
+    start = time.perf_counter()
+    await asyncio.gather(*(_client(rows[k::concurrency], host, port, unix_path, stats, labels)
+                           for k in range(concurrency)))
+    wall = time.perf_counter() - start
+    summary = stats.summary()
+    return {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "seconds": wall,
+        "requests_per_second": n_requests / wall,
+        "latency": summary["stages"].get("request"),
+        "errors": summary["counters"].get("errors", 0),
+        "labels": labels,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="run the labeling service")
+    serve.add_argument("--model", help="spaCy pipeline name or path (default: the model of Hw2_0716235)")
+    serve.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    serve.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    serve.add_argument("--model-workers", type=int, default=0, help="parse with a ModelPool of N instances")
+    serve.add_argument("--log-level", default="INFO")
+    load = sub.add_parser("load", help="measure throughput and latency of a running service")
+    load.add_argument("--input", default="data.csv")
+    load.add_argument("--requests", type=int, default=2000)
+    load.add_argument("--concurrency", type=int, default=64)
+    for command in (serve, load):
+        command.add_argument("--host", default=HOST)
+        command.add_argument("--port", type=int, default=PORT)
+        command.add_argument("--unix", help="Unix socket path instead of host:port")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        SetupLogging(args.log_level)
+        if args.model is not None:
+            UseModel(rules, args.model)
+        try:
+            asyncio.run(Serve(args.host, args.port, args.unix, args.max_batch, args.max_wait_ms,
+                              args.model_workers))
+        except KeyboardInterrupt:
+            pass
+        return
+    result = asyncio.run(LoadTest(args.input, args.requests, args.concurrency, args.host, args.port, args.unix))
+    del result["labels"]
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
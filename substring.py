@@ -0,0 +1,167 @@
+# Author: Yu-Lun Hsu
+# Student ID: 0716235
+# HW ID: hw2
+# Due Date: 04/16/2022
+
+'''
+Multi-string substring matching for the candidate checks of the engines.
+
+The engines compare every row against all the candidates extracted from
+its sentence, in one of two directions:
+    - method3 (subobj_check): is the given S / O a substring of a candidate?
+      SubstringIndex, a generalized suffix automaton over the candidates.
+    - method1 (Judge): is a candidate a substring of the given S / V / O?
+      AhoCorasick, a multi-pattern automaton over the candidates.
+Both are built once per sentence; a query is one pass over the given
+string and returns the matching candidates as a bitmask (bit k for the
+k-th candidate).
+'''
+
+from collections import deque
+from typing import Dict, List, Sequence
+
+
+class SubstringIndex:
+    '''
+    Generalized suffix automaton over texts. Every state keeps the bitmask
+    of the texts in which its substrings occur.
+
+    Example
+    ---------
+    >>> index = SubstringIndex(["the importance", "he", "americans"])
+    >>> bin(index.containing("he"))      # "the importance" and "he"
+    '0b11'
+    >>> index.containing("she")
+    0
+    '''
+
+    def __init__(self, texts: Sequence[str]):
+        self.texts = list(texts)
+        self.all = (1 << len(self.texts)) - 1
+        self.next: List[Dict[str, int]] = [{}]
+        self.link: List[int] = [-1]
+        self.length: List[int] = [0]
+        self.mask: List[int] = [0]
+        for k, text in enumerate(self.texts):
+            bit = 1 << k
+            last = 0
+            for ch in text:
+                last = self._extend(last, ch)
+                # every suffix of the prefix read so far occurs in text k
+                state = last
+                while state > 0 and not self.mask[state] & bit:
+                    self.mask[state] |= bit
+                    state = self.link[state]
+
+    def _new(self, length: int, link: int = -1, transitions: Dict[str, int] = None, mask: int = 0) -> int:
+        self.next.append(dict(transitions) if transitions is not None else {})
+        self.link.append(link)
+        self.length.append(length)
+        self.mask.append(mask)
+        return len(self.length) - 1
+
+    def _clone(self, p: int, q: int, ch: str) -> int:
+        '''
+        Split state q so that the transition p -ch-> has a state of length len(p) + 1
+        '''
+        clone = self._new(self.length[p] + 1, self.link[q], self.next[q], self.mask[q])
+        while p != -1 and self.next[p].get(ch) == q:
+            self.next[p][ch] = clone
+            p = self.link[p]
+        self.link[q] = clone
+        return clone
+
+    def _extend(self, last: int, ch: str) -> int:
+        q = self.next[last].get(ch)
+        if q is not None:
+            # the extended prefix already occurs in a previous text
+            if self.length[q] == self.length[last] + 1:
+                return q
+            return self._clone(last, q, ch)
+        cur = self._new(self.length[last] + 1)
+        p = last
+        while p != -1 and ch not in self.next[p]:
+            self.next[p][ch] = cur
+            p = self.link[p]
+        if p == -1:
+            self.link[cur] = 0
+        else:
+            q = self.next[p][ch]
+            if self.length[q] == self.length[p] + 1:
+                self.link[cur] = q
+            else:
+                self.link[cur] = self._clone(p, q, ch)
+        return cur
+
+    def containing(self, query: str) -> int:
+        '''
+        Bitmask of the texts which contain query (bit k for texts[k])
+        '''
+        state = 0
+        for ch in query:
+            state = self.next[state].get(ch)
+            if state is None:
+                return 0
+        return self.mask[state] if state > 0 else self.all
+
+    def any_containing(self, query: str) -> bool:
+        return self.containing(query) != 0
+
+
+class AhoCorasick:
+    '''
+    Aho-Corasick automaton over patterns, finds every pattern contained in a text
+
+    Example
+    ---------
+    >>> matcher = AhoCorasick(["he", "knows", "the importance"])
+    >>> bin(matcher.contained_in("he knows"))     # "he" and "knows"
+    '0b11'
+    '''
+
+    def __init__(self, patterns: Sequence[str]):
+        self.patterns = list(patterns)
+        self.next: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[int] = [0]
+        # the empty string is contained in every text
+        self.empty = 0
+        for k, pattern in enumerate(self.patterns):
+            if len(pattern) == 0:
+                self.empty |= 1 << k
+                continue
+            state = 0
+            for ch in pattern:
+                nxt = self.next[state].get(ch)
+                if nxt is None:
+                    self.next.append({})
+                    self.fail.append(0)
+                    self.out.append(0)
+                    nxt = len(self.next) - 1
+                    self.next[state][ch] = nxt
+                state = nxt
+            self.out[state] |= 1 << k
+        # breadth first, the fail state of a node is set before its children
+        queue = deque(self.next[0].values())
+        while len(queue) > 0:
+            state = queue.popleft()
+            for ch, child in self.next[state].items():
+                queue.append(child)
+                f = self.fail[state]
+                while f > 0 and ch not in self.next[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.next[f].get(ch, 0)
+                self.out[child] |= self.out[self.fail[child]]
+
+    def contained_in(self, text: str) -> int:
+        '''
+        Bitmask of the patterns which occur in text (bit k for patterns[k])
+        '''
+        mask = self.empty
+        state = 0
+        for ch in text:
+            while state > 0 and ch not in self.next[state]:
+                state = self.fail[state]
+            state = self.next[state].get(ch, 0)
+            mask |= self.out[state]
+        return mask
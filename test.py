@@ -7,7 +7,9 @@ from spacy import tokens
 from spacy import displacy
 import textacy
 
-NLP = spacy.load("en_core_web_sm")
+from models import LazyModel
+
+NLP = LazyModel("en_core_web_sm")
 
 # https://blog.csdn.net/u010087338/article/details/121055591
 OBJECT_DEPS = {"dobj", "attr", "dative", "oprd"}
@@ -1,5 +1,222 @@
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import tempfile
 import unittest
-from Hw2_0716235 import *
+import warnings
+
+import numpy
+import pandas as pd
+import spacy
+from spacy.language import Language
+from spacy.tokens.doc import Doc
+from spacy.tokens.token import Token
+
+import Hw2_0716235
+from Hw2_0716235 import (MAX_TREE_DEPTH, NLP, NOUN_POS, OBJECT_DEPS, SUBJECT_DEPS, DisableTrace, EnableTrace,
+                         ExtractDocAlignments, FindSpans, ObjectCheck, ObjectSet, RuleArrays, RulesCheck,
+                         SubjectCheck, SubjectSet, TokenIndex, is_verb, main)
+from instrument import Stats
+from label_cache import LabelStore, RuleVersion
+from labeling import CHECKPOINT_SUFFIX, LabelRows, LabelSharded, LabelStream, LoadCheckpoint
+from model_pool import ModelPool
+from models import LazyModel
+from parse_cache import DocCache, DocStore, PhraseVectors
+from preprocess import TEXT_COLUMNS, lower, preprocessCSV, removeSign
+from substring import AhoCorasick, SubstringIndex
+import method3
+import service
+
+# Vocab with the lexical attributes of English (lower_, ...), for hand parsed Docs
+VOCAB = spacy.blank("en").vocab
+
+
+def ParsedDoc(words, heads, deps, pos, tags=None, vocab=VOCAB) -> Doc:
+    '''
+    Doc with a given parse (heads are token positions), so the rules can be
+    tested without loading a model
+    '''
+    return Doc(vocab, words=words, heads=heads, deps=deps, pos=pos, tags=tags)
+
+
+# Dependency labels of the children of a random parse, by kind of head and side
+CHILD_DEPS = {
+    ("verb", "left"): "nsubj nsubj nsubj nsubjpass csubj expl aux auxpass npadvmod advmod".split(),
+    ("verb", "right"): "dobj dobj dative attr oprd prep prep agent conj conj cc xcomp ccomp npadvmod advcl".split(),
+    ("adp", "left"): ["advmod"],
+    ("adp", "right"): "pobj pobj pobj conj cc".split(),
+    ("noun", "left"): "det amod poss compound".split(),
+    ("noun", "right"): "prep conj conj cc relcl appos".split(),
+    ("other", "left"): ["advmod"],
+    ("other", "right"): ["conj", "cc"],
+}
+NOUN_DEPS = {"nsubj", "nsubjpass", "expl", "dobj", "dative", "attr", "oprd", "pobj", "npadvmod", "compound", "appos"}
+DEP_POS = {"csubj": "VERB", "xcomp": "VERB", "ccomp": "VERB", "relcl": "VERB", "advcl": "VERB",
+           "aux": "AUX", "auxpass": "AUX", "prep": "ADP", "agent": "ADP", "cc": "CCONJ", "det": "DET",
+           "amod": "ADJ", "advmod": "ADV", "poss": "PRON"}
+# Few words per POS (and "saw" both VERB and AUX), so S, V, O occur several times
+POS_WORDS = {"NOUN": ["cat", "dog"], "PRON": ["he", "her", "it"], "PROPN": ["alan"], "VERB": ["saw", "kissed"],
+             "AUX": ["was", "saw"], "ADP": ["to", "by"], "CCONJ": ["and"], "DET": ["the"], "ADJ": ["big"],
+             "ADV": ["then"]}
+HEAD_KINDS = {"VERB": "verb", "AUX": "verb", "ADP": "adp", "NOUN": "noun", "PRON": "noun", "PROPN": "noun"}
+
+
+def RandomTree(start: int, end: int, heads, rnd: random.Random) -> int:
+    '''
+    Fill heads[start:end] with a random projective tree, return its root
+    '''
+    root = rnd.randrange(start, end)
+    for low, high in ((start, root), (root + 1, end)):
+        i = low
+        while i < high:
+            j = rnd.randrange(i, high) + 1
+            heads[RandomTree(i, j, heads, rnd)] = root
+            i = j
+    return root
+
+
+def RandomParsedDoc(rnd: random.Random, n: int = None) -> Doc:
+    '''
+    Doc with a random projective parse; the label of each token is drawn
+    from the ones its head usually takes (subjects on the left of verbs,
+    pobj under prepositions, ...) and its POS follows from the label
+    '''
+    n = n or rnd.randint(2, 16)
+    heads = [0] * n
+    root = RandomTree(0, n, heads, rnd)
+    heads[root] = root
+    deps, pos = [""] * n, [""] * n
+    deps[root], pos[root] = "ROOT", rnd.choice(["VERB", "VERB", "AUX"])
+    order = [root]
+    for head in order:
+        for child in range(n):
+            if heads[child] == head and child != head:
+                dep = rnd.choice(CHILD_DEPS[HEAD_KINDS.get(pos[head], "other"), "left" if child < head else "right"])
+                if dep == "conj":
+                    pos[child] = pos[head]
+                elif dep in NOUN_DEPS:
+                    pos[child] = rnd.choice(["NOUN", "NOUN", "PRON", "PROPN"])
+                else:
+                    pos[child] = DEP_POS[dep]
+                deps[child] = dep
+                order.append(child)
+    tags = ["PRP$" if d == "poss" else "NN" if HEAD_KINDS.get(p) == "noun" else "VB" for d, p in zip(deps, pos)]
+    return Doc(VOCAB, words=[rnd.choice(POS_WORDS[p]) for p in pos], heads=heads, deps=deps, pos=pos, tags=tags,
+               ents=[rnd.choice(["O"] * 8 + ["B-TIME", "B-DATE"]) for _ in range(n)])
+
+
+def RandomSVO(rnd: random.Random, doc: Doc):
+    '''
+    S, V, O phrases of doc in order: any three spans, or nouns around a verb
+    '''
+    n = len(doc)
+    if n < 3:
+        return tuple(doc[rnd.randrange(n)].text for _ in range(3))
+    phrase = lambda i, limit: doc[i:min(limit, i + rnd.choice([1, 1, 1, 2]))].text
+    verbs = [t.i for t in doc[1:-1] if t.pos_ in ("VERB", "AUX")]
+    if len(verbs) == 0 or rnd.random() < 0.5:
+        i, j, k = sorted(rnd.sample(range(n), 3))
+        return phrase(i, j), phrase(j, k), phrase(k, n)
+    v = rnd.choice(verbs)
+    subjects = [t.i for t in doc[:v] if t.pos_ in NOUN_POS] or [0]
+    objects = [t.i for t in doc[v + 1:] if t.pos_ in NOUN_POS] or [n - 1]
+    return phrase(rnd.choice(subjects), v), phrase(v, v + 1), phrase(rnd.choice(objects), n)
+
+
+# Hand parsed Docs by sentence, returned by HandParser instead of parsing
+HAND_PARSES = {}
+
+
+class HandParser:
+    '''
+    Stand-in for a pipeline whose pipe() returns the Docs of HAND_PARSES
+    '''
+
+    def pipe(self, items, as_tuples=False, **kwargs):
+        for text, context in items:
+            yield HAND_PARSES[text], context
+
+
+def LoadHandParser() -> HandParser:
+    return HandParser()
+
+
+def HandParsedRows(rnd: random.Random, n_docs: int, rows_per_doc: int) -> pd.DataFrame:
+    '''
+    Rows (S, V, O, sentence) of random parses, which are added to HAND_PARSES
+    '''
+    rows = []
+    while len(HAND_PARSES) < n_docs:
+        doc = RandomParsedDoc(rnd)
+        HAND_PARSES.setdefault(doc.text, doc)
+    for sentence, doc in list(HAND_PARSES.items())[:n_docs]:
+        rows.extend(RandomSVO(rnd, doc) + (sentence,) for _ in range(rows_per_doc))
+    return pd.DataFrame(rows, columns=["S", "V", "O", "sentence"])
+
+
+# She kissed me .
+KISSED = (["She", "kissed", "me", "."], [1, 1, 1, 1], ["nsubj", "ROOT", "dobj", "punct"],
+          ["PRON", "VERB", "PRON", "PUNCT"])
+# The the the cat sat .
+THE_CAT = (["The", "the", "the", "cat", "sat", "."], [3, 3, 3, 4, 4, 4],
+           ["det", "det", "det", "nsubj", "ROOT", "punct"], ["DET", "DET", "DET", "NOUN", "VERB", "PUNCT"])
+# Her cat saw her kiss him .
+HER_KISS = (["Her", "cat", "saw", "her", "kiss", "him", "."], [1, 2, 2, 4, 2, 4, 2],
+            ["poss", "nsubj", "ROOT", "nsubj", "ccomp", "dobj", "punct"],
+            ["PRON", "NOUN", "VERB", "PRON", "VERB", "PRON", "PUNCT"],
+            ["PRP$", "NN", "VBD", "PRP", "VB", "PRP", "."])
+
+
+# The rules on Tokens with recursion, as they were before DocArrays and the
+# worklists, for the differential tests of the optimized versions
+def ref_conj_check(noun: Token, tokens, deps) -> bool:
+    for t in tokens:
+        rights = list(t.rights)
+        if "cc" in {r.dep_ for r in rights}:
+            joined = [r for r in rights if r.dep_ in deps or r.dep_ == "conj"]
+            if noun in joined or ref_conj_check(noun, joined, deps):
+                return True
+    return False
+
+
+def ref_subj_in_ancestors(noun: Token, v: Token) -> bool:
+    current = v.head
+    while current.pos_ != "VERB" and current.pos_ not in NOUN_POS and current.head != current:
+        current = current.head
+    if current.pos_ == "VERB":
+        subs = list(current.lefts)
+        if noun in subs or ref_conj_check(noun, subs, SUBJECT_DEPS):
+            return True
+        return current.head != current and ref_subj_in_ancestors(noun, current)
+    return current.pos_ in NOUN_POS and noun == current
+
+
+def ref_subject_check(noun: Token, v: Token) -> bool:
+    lefts = [x for x in v.lefts if x.dep_ in SUBJECT_DEPS]
+    return noun in lefts or ref_conj_check(noun, lefts, SUBJECT_DEPS) or ref_subj_in_ancestors(noun, v)
+
+
+def ref_object_check(noun: Token, v: Token) -> bool:
+    if any(x.dep_ == "auxpass" for x in v.lefts):
+        rights = [x for x in v.rights if x.dep_ in OBJECT_DEPS or x.dep_ in {"prep", "agent"}]
+    else:
+        rights = [x for x in v.rights if x.dep_ in OBJECT_DEPS]
+    if noun in rights:
+        return True
+    children = list(v.rights)
+    verbs = [c for c in children if is_verb(c) and c.dep_ in {"xcomp", "ccomp"}]
+    if len(children) > 1 and children[0].pos_ == "CCONJ":
+        verbs.extend(c for c in children[1:] if is_verb(c))
+    if any(ref_object_check(noun, c) for c in verbs):
+        return True
+    for t in rights:
+        if t.pos_ == "ADP" and t.dep_ in {"prep", "agent", "dative"}:
+            objs = [r for r in t.rights if r.dep_ in OBJECT_DEPS or r.pos_ == "PRON"]
+            if noun in objs or ref_conj_check(noun, objs, OBJECT_DEPS):
+                return True
+    return False
 
 
 class TestInverse(unittest.TestCase):
@@ -113,6 +330,606 @@ class TestInverse(unittest.TestCase):
             self.assertEqual(valid, RulesCheck(S, V, O,  NLP(sent)), (S,V,O))
 
 
+
+class TestAlignment(unittest.TestCase):
+    def test_overlapping_spans(self):
+        doc = ParsedDoc(*THE_CAT)
+        index = TokenIndex(doc)
+        self.assertEqual(FindSpans(doc, index, "the the cat"), [(1, 4)])
+        self.assertEqual(FindSpans(doc, index, "the"), [(0, 1), (1, 2), (2, 3)])
+        self.assertEqual(FindSpans(doc, index, "the cat the"), [])
+
+    def test_second_alignment_after_type_check(self):
+        # the first "her" is possessive (PRP$) and fails the subject type check
+        doc = ParsedDoc(*HER_KISS)
+        alignments = list(ExtractDocAlignments(doc, "her", "kiss", "him"))
+        self.assertEqual([([s.i for s in S], [v.i for v in V], [o.i for o in O]) for S, V, O in alignments],
+                         [([3], [4], [5])])
+        self.assertTrue(RulesCheck("her", "kiss", "him", doc))
+
+
+def RandomTexts(rnd: random.Random, n: int, max_len: int):
+    '''
+    n random strings over a small alphabet (so they overlap a lot), empty ones included
+    '''
+    return ["".join(rnd.choice("ab c") for _ in range(rnd.randint(0, max_len))) for _ in range(n)]
+
+
+class TestSubstring(unittest.TestCase):
+    def test_substring_index_matches_in(self):
+        rnd = random.Random(21)
+        for _ in range(300):
+            texts = RandomTexts(rnd, rnd.randint(0, 6), 10)
+            index = SubstringIndex(texts)
+            for query in RandomTexts(rnd, 20, 5) + [""] + texts:
+                expected = sum(1 << k for k, text in enumerate(texts) if query in text)
+                self.assertEqual(index.containing(query), expected, (texts, query))
+                self.assertEqual(index.any_containing(query), expected != 0, (texts, query))
+
+    def test_aho_corasick_matches_in(self):
+        rnd = random.Random(22)
+        for _ in range(300):
+            patterns = RandomTexts(rnd, rnd.randint(0, 6), 5)
+            matcher = AhoCorasick(patterns)
+            for text in RandomTexts(rnd, 20, 12) + [""] + patterns:
+                expected = sum(1 << k for k, pattern in enumerate(patterns) if pattern in text)
+                self.assertEqual(matcher.contained_in(text), expected, (patterns, text))
+
+
+class Crash(Exception):
+    pass
+
+
+class TestLabelStream(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.csv = os.path.join(self.dir.name, "data.csv")
+        rows = ["id,S,V,O,sentence"]
+        for k in range(12):
+            sentence = "she kissed {} and hugged him {} .".format(k, k)
+            for S, V, O in (("she", "kissed", str(k)), ("she", "hugged", "him"), ("him", "kissed", "she")):
+                rows.append("{},{},{},{},{}".format(len(rows) - 1, S, V, O, sentence))
+        with open(self.csv, "w") as f:
+            f.write("\n".join(rows) + "\n")
+        self.nlp = spacy.blank("en")
+        self.judged = 0
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def judge(self, S, V, O, doc):
+        self.judged += 1
+        words = [t.lower_ for t in doc]
+        return int(words.index(S) < words.index(V) < len(words) - 1 - words[::-1].index(O))
+
+    def crashing_judge(self, S, V, O, doc):
+        if self.judged == 20:
+            raise Crash()
+        return self.judge(S, V, O, doc)
+
+    def run_stream(self, answer, judge, resume=False):
+        return LabelStream(self.csv, self.nlp, judge, answer, chunksize=5,
+                           checkpoint_path=answer + CHECKPOINT_SUFFIX, resume=resume)
+
+    def test_resume_after_crash(self):
+        expected = os.path.join(self.dir.name, "expected.csv")
+        expected_counts = self.run_stream(expected, self.judge)
+        self.assertFalse(os.path.exists(expected + CHECKPOINT_SUFFIX))
+
+        answer = os.path.join(self.dir.name, "answer.csv")
+        self.judged = 0
+        with self.assertRaises(Crash):
+            self.run_stream(answer, self.crashing_judge)
+        state = LoadCheckpoint(answer + CHECKPOINT_SUFFIX)
+        self.assertTrue(0 < state["rows_done"] < 36)
+        # rows labeled after the last checkpoint are written again on resume
+        with open(answer, "a") as f:
+            f.write("999,1\n")
+
+        self.judged = 0
+        counts = self.run_stream(answer, self.judge, resume=True)
+        self.assertEqual(self.judged, 36 - state["rows_done"])
+        self.assertEqual(counts, expected_counts)
+        with open(answer) as f, open(expected) as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertFalse(os.path.exists(answer + CHECKPOINT_SUFFIX))
+
+
+# Rules of a toy engine, RuleVersion is computed on edited copies of it
+TOY_RULES = '''
+NOUNS = {"cat", "dog"}
+
+
+def is_noun(word):
+    return word in NOUNS
+
+
+def judge(S, V, O, doc):
+    """
+    Subject and object are nouns
+    """
+    # the verb is not checked
+    return int(is_noun(S) and is_noun(O))
+'''
+
+
+class TestLabelCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def version(self, name: str, source: str) -> str:
+        path = os.path.join(self.dir.name, name + ".py")
+        with open(path, "w") as f:
+            f.write(source)
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return RuleVersion(module.judge)
+
+    def test_rule_version(self):
+        base = self.version("toy_base", TOY_RULES)
+        commented = TOY_RULES.replace("# the verb is not checked", "# V is ignored").replace(
+            "Subject and object are nouns", "S and O must be nouns")
+        self.assertEqual(self.version("toy_comment", commented), base)
+        self.assertNotEqual(self.version("toy_constant", TOY_RULES.replace('"dog"', '"dog", "bird"')), base)
+        self.assertNotEqual(self.version("toy_rule", TOY_RULES.replace("is_noun(O)", "not is_noun(O)")), base)
+
+    def test_rule_change_misses_and_comment_change_hits(self):
+        path = os.path.join(self.dir.name, "labels.sqlite")
+        row = ("cat", "saw", "dog", "the cat saw the dog .")
+        base = self.version("toy_base", TOY_RULES)
+        with LabelStore(path, "toy", base, "blank_en") as memo:
+            memo.put_many([row], [1])
+        commented = self.version("toy_comment", TOY_RULES.replace("# the verb is not checked", "# V is ignored"))
+        changed = self.version("toy_rule", TOY_RULES.replace("is_noun(O)", "not is_noun(O)"))
+        with LabelStore(path, "toy", commented, "blank_en") as memo:
+            self.assertEqual(memo.get_many([row]), [1])
+        with LabelStore(path, "toy", changed, "blank_en") as memo:
+            self.assertEqual(memo.get_many([row]), [None])
+            memo.put_many([row], [0])
+        # opening a store of another version does not delete the labels, prune does
+        with LabelStore(path, "toy", base, "blank_en") as memo:
+            self.assertEqual(memo.get_many([row]), [1])
+            self.assertEqual(memo.prune(), 1)
+            self.assertEqual(len(memo), 1)
+
+    def test_cached_rows_are_counted(self):
+        df = pd.DataFrame({"S": ["she", "she", "him"], "V": ["kissed", "hugged", "kissed"],
+                           "O": ["me", "me", "she"], "sentence": ["she kissed me ."] * 2 + ["him kissed she ."]})
+        nlp = spacy.blank("en")
+        judge = lambda S, V, O, doc: int(S == doc[0].lower_)
+        with LabelStore(os.path.join(self.dir.name, "labels.sqlite"), "toy", "1", "blank_en") as memo:
+            for run in range(2):
+                stats = Stats()
+                self.assertEqual(LabelRows(df, nlp, judge, memo=memo, stats=stats), [1, 1, 1])
+                self.assertEqual(stats.counters["rows"], 3)
+                self.assertEqual(stats.counters["memo_hits"], 3 * run)
+
+
+def RowLoop(df: pd.DataFrame, judge, prepare=None):
+    '''
+    Labels of df row by row, each row judged on its own hand parsed Doc
+    '''
+    labels = []
+    for S, V, O, sentence in df[["S", "V", "O", "sentence"]].itertuples(index=False):
+        doc = HAND_PARSES[sentence]
+        labels.append(int(judge(S, V, O, doc if prepare is None else prepare(doc))))
+    return labels
+
+
+class TestLabelRows(unittest.TestCase):
+    def test_labels_equal_row_loop(self):
+        df = HandParsedRows(random.Random(2), 200, 5).sample(frac=1, random_state=2).reset_index(drop=True)
+        expected = RowLoop(df, RulesCheck)
+        self.assertTrue(0 < sum(expected) < len(expected))
+        self.assertEqual(LabelRows(df, HandParser(), RulesCheck, batch_size=7), expected)
+        cache = DocCache(HandParser(), maxsize=64)
+        # cold, then with the last 64 sentences cached
+        for _ in range(2):
+            self.assertEqual(LabelRows(df, HandParser(), RulesCheck, cache=cache), expected)
+
+
+def ParseOf(doc: Doc):
+    return [(t.text, t.head.i, t.dep_, t.pos_, t.tag_, t.ent_type_, t.is_sent_start) for t in doc]
+
+
+class TestDocStore(unittest.TestCase):
+    def test_stored_docs_label_like_the_parses(self):
+        df = HandParsedRows(random.Random(5), 100, 4)
+        sentences = list(dict.fromkeys(df["sentence"]))
+        nlp = spacy.blank("en")
+        with tempfile.TemporaryDirectory() as path:
+            store = DocStore(path, nlp, flush_size=16)
+            worker = DocStore(path, nlp, readonly=True)
+            for k, sentence in enumerate(sentences):
+                (store if k % 2 == 0 else worker).put(sentence, HAND_PARSES[sentence])
+            worker.save()
+            store.add_new(worker.take_new())
+            store.close()
+            store = DocStore(path, nlp)
+            self.assertEqual(len(store), len(sentences))
+            for sentence in sentences:
+                self.assertEqual(ParseOf(store.get(sentence)), ParseOf(HAND_PARSES[sentence]))
+            labels = LabelRows(df, HandParser(), RulesCheck, cache=DocCache(HandParser(), store=store))
+            self.assertEqual((store.hits, store.misses), (2 * len(sentences), 0))
+            store.close()
+        self.assertEqual(labels, RowLoop(df, RulesCheck))
+
+
+class TestDecisionLog(unittest.TestCase):
+    def test_tracing_keeps_the_labels(self):
+        df = HandParsedRows(random.Random(6), 100, 4)
+        expected = RowLoop(df, RulesCheck)
+        trace = EnableTrace()
+        try:
+            labels = LabelRows(df, HandParser(), RulesCheck)
+        finally:
+            DisableTrace()
+        self.assertEqual(labels, expected)
+        self.assertEqual([record["label"] for record in trace.records], expected)
+        for record, label in zip(trace.records, expected):
+            reasons = {event[0] for event in record["events"]}
+            if label == 1:
+                self.assertTrue(any(r.startswith("SUBJ_") for r in reasons - {"SUBJ_NOT_FOUND"}), record)
+                self.assertTrue(any(r.startswith("OBJ_") for r in reasons - {"OBJ_NOT_FOUND"}), record)
+            else:
+                self.assertTrue(reasons & {"TYPE_CHECK_FAILED", "SUBJ_NOT_FOUND", "OBJ_NOT_FOUND"}, record)
+        # debug logging notes the reasons as well
+        with self.assertLogs("Hw2_0716235", "DEBUG"):
+            self.assertEqual(LabelRows(df, HandParser(), RulesCheck), expected)
+
+
+class TestStats(unittest.TestCase):
+    def test_timed_labels_equal_untimed(self):
+        df = HandParsedRows(random.Random(7), 100, 4)
+        expected = RowLoop(df, RulesCheck)
+        stats = Stats()
+        # the stages of RulesCheck are timed when its module has STATS set
+        Hw2_0716235.STATS = stats
+        try:
+            labels = LabelRows(df, HandParser(), RulesCheck, stats=stats)
+        finally:
+            Hw2_0716235.STATS = None
+        self.assertEqual(labels, expected)
+        summary = stats.summary()
+        n_sentences = df["sentence"].nunique()
+        self.assertEqual(summary["counters"], {"rows": len(df), "sentences": n_sentences})
+        calls = {stage: summary["stages"][stage]["calls"] for stage in ("parse", "judge", "sentence", "alignment")}
+        self.assertEqual(calls, {"parse": n_sentences, "judge": len(df), "sentence": n_sentences,
+                                 "alignment": len(df)})
+        # the tree checks are timed for the rows having an alignment
+        aligned = RowLoop(df, lambda S, V, O, doc: next(ExtractDocAlignments(doc, S, V, O), None) is not None)
+        self.assertEqual(summary["stages"]["tree_check"]["calls"], sum(aligned))
+
+
+class TestPreprocess(unittest.TestCase):
+    def test_equals_per_value_functions(self):
+        rnd = random.Random(15)
+        pieces = ["``", "`", "''", "'", '"', " ", "  ", "\t", "He", "SAID", "Ça", "x"]
+        values = ["".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 8))) for _ in range(300)]
+        df = pd.DataFrame({col: [rnd.choice(values) for _ in range(1000)] for col in TEXT_COLUMNS})
+        df["id"] = range(len(df))
+        expected = df.copy()
+        for col in TEXT_COLUMNS:
+            expected[col] = [lower(removeSign(x)) for x in df[col]]
+        pd.testing.assert_frame_equal(preprocessCSV(df), expected)
+
+
+class TestSharded(unittest.TestCase):
+    def test_sharded_labels_equal_serial(self):
+        df = HandParsedRows(random.Random(4), 300, 4)
+        serial = LabelRows(df, HandParser(), RulesCheck)
+        self.assertTrue(0 < sum(serial) < len(serial))
+        self.assertEqual(LabelSharded(df, LoadHandParser, RulesCheck, n_workers=3), serial)
+        self.assertEqual(LabelSharded(df, LoadHandParser, RulesCheck, n_workers=2, stats=Stats()), serial)
+
+    def test_trace_needs_one_process(self):
+        with self.assertRaises(ValueError):
+            main(trace_path=os.devnull, n_workers=2)
+
+
+# hand parses by text, set by the "hand_parser" pipe of the pipeline saved in TestModelPool
+POOL_PARSES = {" ".join(KISSED[0]): KISSED, " ".join(HER_KISS[0]): HER_KISS}
+
+
+@Language.component("hand_parser")
+def hand_parser(doc: Doc) -> Doc:
+    _, heads, deps, pos = POOL_PARSES[doc.text][:4]
+    for token, head, dep, tag in zip(doc, heads, deps, pos):
+        token.head, token.dep_, token.pos_ = doc[head], dep, tag
+    return doc
+
+
+class TestModelPool(unittest.TestCase):
+    def test_process_pool_returns_the_parse(self):
+        with tempfile.TemporaryDirectory() as path:
+            nlp = spacy.blank("en")
+            nlp.add_pipe("hand_parser")
+            nlp.to_disk(path)
+            with ModelPool(LazyModel(path), n_workers=1, kind="process") as pool:
+                texts = list(POOL_PARSES)
+                docs = pool.submit(texts).result() + list(pool.pipe(texts))
+            for doc in docs:
+                words, heads, deps, pos = POOL_PARSES[doc.text][:4]
+                self.assertEqual([t.lower_ for t in doc], [w.lower() for w in words])
+                self.assertEqual([t.head.i for t in doc], heads)
+                self.assertEqual([t.dep_ for t in doc], deps)
+                self.assertEqual([t.pos_ for t in doc], pos)
+            self.assertTrue(RulesCheck("she", "kissed", "me", docs[0]))
+            self.assertTrue(RulesCheck("her", "kiss", "him", docs[1]))
+
+    def test_store_reads_into_the_pool_vocab(self):
+        with tempfile.TemporaryDirectory() as path:
+            spacy.blank("en").to_disk(os.path.join(path, "model"))
+            model = LazyModel(os.path.join(path, "model"))
+            with ModelPool(model, n_workers=1, kind="process") as pool:
+                store = DocStore(path, model, vocab=pool.vocab)
+                store.put("text", ParsedDoc(*KISSED))
+                store.save()
+                doc = DocStore(path, model, vocab=pool.vocab).get("text")
+            self.assertIs(doc.vocab, pool.vocab)
+            self.assertEqual([t.head.i for t in doc], KISSED[1])
+            self.assertFalse(model.loaded)
+
+# sizes of the batches given to StubBatch
+STUB_BATCHES = []
+
+
+def StubBatch(rows):
+    # stands in for LabelBatch: "she" subjects are labeled 1, no model involved
+    STUB_BATCHES.append(len(rows))
+    return [{"label": int(row["S"] == "she")} for row in rows]
+
+
+async def Request(port: int, data: bytes, eof: bool = False):
+    reader, writer = await asyncio.open_connection(service.HOST, port)
+    try:
+        writer.write(data)
+        if eof:
+            writer.write_eof()
+        await writer.drain()
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        length = int(head.lower().split("content-length:")[1].split("\r\n")[0])
+        return head.split(" ", 2)[1], json.loads(await reader.readexactly(length))
+    finally:
+        writer.close()
+
+
+def Post(body: bytes) -> bytes:
+    return "POST /label HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body
+
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        STUB_BATCHES.clear()
+
+    def test_rows_are_batched(self):
+        async def run():
+            batcher = service.MicroBatcher(StubBatch, max_batch=4, max_wait_ms=200)
+            batcher.start()
+            try:
+                rows = [{"S": S} for S in ["she", "he"] * 5]
+                results = await asyncio.gather(*(batcher.submit(row) for row in rows))
+            finally:
+                await batcher.stop()
+            self.assertEqual(results, [{"label": 1}, {"label": 0}] * 5)
+            self.assertEqual(STUB_BATCHES, [4, 4, 2])
+            self.assertEqual((batcher.batches, batcher.items), (3, 10))
+        asyncio.run(run())
+
+    def test_service_answers_every_request(self):
+        async def run():
+            batcher = service.MicroBatcher(StubBatch, max_batch=4, max_wait_ms=1)
+            batcher.start()
+            server = await asyncio.start_server(service.LabelService(batcher).handle, service.HOST, 0,
+                                                limit=service.MAX_HEAD)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                row = {"S": "she", "V": "kissed", "O": "me", "sentence": "she kissed me ."}
+                self.assertEqual(await Request(port, Post(json.dumps(row).encode())), ("200", {"label": 1}))
+                status, body = await Request(port, b"GET /health HTTP/1.1\r\n\r\n")
+                self.assertEqual((status, body["status"], body["rows"]), ("200", "ok", 1))
+                self.assertEqual((await Request(port, Post(b"not json")))[0], "400")
+                self.assertEqual((await Request(port, Post(b'{"S": "she"}')))[0], "400")
+                # Content-Length longer than the body the client sent before closing
+                truncated = b"POST /label HTTP/1.1\r\nContent-Length: 100\r\n\r\n{}"
+                self.assertEqual((await Request(port, truncated, eof=True))[0], "400")
+                self.assertEqual((await Request(port, b"POST /label HTTP/1.1\r\nContent-Length: x\r\n\r\n"))[0],
+                                 "400")
+                huge = b"GET /health HTTP/1.1\r\nX-Padding: " + b"a" * (service.MAX_HEAD + 100)
+                self.assertEqual((await Request(port, huge, eof=True))[0], "413")
+                self.assertEqual(STUB_BATCHES, [1])
+            finally:
+                server.close()
+                await server.wait_closed()
+                await batcher.stop()
+        asyncio.run(run())
+
+def ConjChainDoc(n: int) -> Doc:
+    '''
+    he and he and ... saw it, with n conjunctions: the k-th "he" is k conjunctions deep
+    '''
+    return ParsedDoc(["he"] + ["and", "he"] * n + ["saw", "it"],
+                     [2 * n + 1] + [2 * (i // 2) for i in range(2 * n)] + [2 * n + 1, 2 * n + 1],
+                     ["nsubj"] + ["cc", "conj"] * n + ["ROOT", "dobj"],
+                     ["PRON"] + ["CCONJ", "PRON"] * n + ["VERB", "PRON"])
+
+
+class TestRuleSets(unittest.TestCase):
+    def test_checks_equal_token_rules(self):
+        rnd = random.Random(10)
+        found = [0, 0]
+        for _ in range(1000):
+            doc = RandomParsedDoc(rnd)
+            for v in doc:
+                for noun in doc:
+                    subject, obj = SubjectCheck(noun, v), ObjectCheck(noun, v)
+                    self.assertEqual(subject, ref_subject_check(noun, v), (doc.text, noun.i, v.i))
+                    self.assertEqual(obj, ref_object_check(noun, v), (doc.text, noun.i, v.i))
+                    found[0] += subject
+                    found[1] += obj
+        self.assertGreater(min(found), 1000)
+
+    def test_memo_shared_by_the_verbs_of_a_doc(self):
+        rnd = random.Random(11)
+        for _ in range(500):
+            doc = RandomParsedDoc(rnd)
+            a = RuleArrays(doc)
+            fresh = {}
+            for v in range(len(doc)):
+                a.memo.clear()
+                fresh[v] = (SubjectSet(a, v), ObjectSet(a, v))
+            a.memo.clear()
+            verbs = list(range(len(doc))) * 2
+            rnd.shuffle(verbs)
+            for v in verbs:
+                self.assertEqual((SubjectSet(a, v), ObjectSet(a, v)), fresh[v], (doc.text, v))
+
+    def test_depth_is_bounded(self):
+        n = 2 * MAX_TREE_DEPTH
+        doc = ConjChainDoc(n)
+        verb = doc[2 * n + 1]
+        for j in range(n + 1):
+            self.assertTrue(ref_subject_check(doc[2 * j], verb))
+            self.assertEqual(SubjectCheck(doc[2 * j], verb), j <= MAX_TREE_DEPTH, j)
+        # far past the recursion limit
+        doc = ConjChainDoc(5000)
+        self.assertTrue(RulesCheck("he", "saw", "it", doc))
+        self.assertTrue(SubjectCheck(doc[2], doc[-2]))
+        self.assertFalse(SubjectCheck(doc[-3], doc[-2]))
+
+    def test_objects_cut_by_the_depth_are_not_kept(self):
+        # he saw saw ... saw it: the object is found through every xcomp
+        n = 8
+        doc = ParsedDoc(["he"] + ["saw"] * (n + 1) + ["it"], [1, 1] + list(range(1, n + 1)) + [n + 1],
+                        ["nsubj", "ROOT"] + ["xcomp"] * n + ["dobj"], ["PRON"] + ["VERB"] * (n + 1) + ["PRON"])
+        a = RuleArrays(doc)
+        self.assertNotIn(n + 2, ObjectSet(a, 1, max_depth=3))
+        for v in range(1, n + 2):
+            self.assertTrue(ref_object_check(doc[n + 2], doc[v]))
+            self.assertIn(n + 2, ObjectSet(a, v), v)
+        self.assertTrue(RulesCheck("he", "saw", "it", doc))
+
+# POS of the words of POS_WORDS ("saw" is a VERB), set by the "word_pos" pipe
+WORD_POS = {w: p for p, words in reversed(list(POS_WORDS.items())) for w in words}
+# words sharing a base vector, so their similarity is mostly over 0.9
+WORD_GROUPS = {"cat": "noun", "dog": "noun", "he": "pron", "her": "pron", "it": "pron",
+               "saw": "verb", "kissed": "verb"}
+
+
+@Language.component("word_pos")
+def word_pos(doc: Doc) -> Doc:
+    for token in doc:
+        token.pos_ = WORD_POS.get(token.text, "X")
+    return doc
+
+
+def VectorModel(rnd: random.Random) -> Language:
+    '''
+    Blank pipeline tagging POS_WORDS with random vectors ("alan" has none)
+    '''
+    nlp = spacy.blank("en")
+    nlp.add_pipe("word_pos")
+    bases = {}
+    for word in WORD_POS:
+        if word != "alan":
+            base = bases.setdefault(WORD_GROUPS.get(word, word), numpy.array([rnd.gauss(0, 1) for _ in range(8)]))
+            nlp.vocab.set_vector(word, base + numpy.array([rnd.gauss(0, 0.4) for _ in range(8)]))
+    return nlp
+
+
+def ref_compare_similarity(S, V, O, answerList, nlp, threshold=0.9) -> int:
+    '''
+    CompareSimilarity as it was: every check of every candidate with Doc.similarity
+    '''
+    S_doc, V_doc, O_doc = nlp(S), nlp(V), nlp(O)
+    if not method3.verb_validaty_check(V_doc) or not method3.noun_check(S_doc) or not method3.noun_check(O_doc):
+        return 0
+    with warnings.catch_warnings():
+        # W008, similarity of a phrase without vector
+        warnings.simplefilter("ignore")
+        for sentence in answerList:
+            for solution in sentence:
+                S_check = S_doc.similarity(nlp(solution[0])) > threshold or method3.subobj_check(S, solution[0])
+                V_check = V_doc.similarity(nlp(solution[1])) > threshold or method3.verb_subset_check(V, solution[1])
+                O_check = O_doc.similarity(nlp(solution[2])) > threshold or method3.subobj_check(O, solution[2])
+                if S_check and V_check and O_check:
+                    return 1
+    return 0
+
+
+def RandomPhrases(rnd: random.Random, doc: Doc):
+    '''
+    S, V, O of doc (RandomSVO) or words drawn from POS_WORDS
+    '''
+    if rnd.random() < 0.7:
+        return RandomSVO(rnd, doc)
+    return tuple(" ".join(rnd.choice(list(WORD_POS)) for _ in range(rnd.randint(1, 2))) for _ in range(3))
+
+
+class TestSimilarity(unittest.TestCase):
+    def setUp(self):
+        self.nlp = VectorModel(random.Random(7))
+        self.phrases, method3.PHRASES = method3.PHRASES, PhraseVectors(self.nlp)
+        method3.CASCADE_COUNTS.clear()
+
+    def tearDown(self):
+        method3.PHRASES = self.phrases
+        method3.CASCADE_COUNTS.clear()
+
+    def test_cascade_equals_full_comparison(self):
+        rnd = random.Random(7)
+        labels = []
+        for _ in range(400):
+            doc = RandomParsedDoc(rnd)
+            svos = method3.SVOParse(doc)
+            index = method3.CandidateIndex(svos)
+            strings = [[tuple(solution) for solution in sentence] for sentence in svos]
+            for _ in range(8):
+                S, V, O = RandomPhrases(rnd, doc)
+                label = method3.CompareSimilarity(S, V, O, index)
+                self.assertEqual(label, ref_compare_similarity(S, V, O, strings, self.nlp), (doc.text, S, V, O))
+                labels.append(label)
+        self.assertGreater(sum(labels), 100)
+        # every stage of the cascade decided some rows
+        for stage in ("invalid", "empty", "string", "vector") + method3.SLOT_STAGES:
+            self.assertGreater(method3.CASCADE_COUNTS[stage], 0, stage)
+
+    def test_index_masks_equal_string_checks(self):
+        rnd = random.Random(8)
+        checks = (method3.subobj_check, method3.verb_subset_check, method3.subobj_check)
+        hits = [0, 0, 0]
+        for _ in range(400):
+            index = method3.IndexSVO(RandomParsedDoc(rnd))
+            texts = [[solution[slot] for solution in index.solutions] for slot in range(3)]
+            for _ in range(8):
+                given = []
+                for slot in range(3):
+                    if len(index) > 0 and rnd.random() < 0.5:
+                        # a piece of a candidate (or for verbs, several of them)
+                        text = rnd.choice(texts[slot])
+                        i = rnd.randrange(len(text))
+                        text = text[i:rnd.randint(i + 1, len(text))]
+                        if slot == 1:
+                            text = " ".join([text] + rnd.sample(texts[1], min(len(index), rnd.randint(0, 9))))
+                        given.append(text)
+                    else:
+                        given.append(rnd.choice(list(WORD_POS)))
+                expected = tuple(sum(1 << k for k, text in enumerate(texts[slot]) if checks[slot](given[slot], text))
+                                 for slot in range(3))
+                self.assertEqual(index.masks(*given), expected, given)
+                hits = [h + (m != 0) for h, m in zip(hits, expected)]
+        self.assertGreater(min(hits), 200)
+
+    def test_prepared_labels_equal_row_loop(self):
+        df = HandParsedRows(random.Random(3), 100, 4).sample(frac=1, random_state=3).reset_index(drop=True)
+        expected = RowLoop(df, method3.CompareSimilarity, method3.SVOParse)
+        self.assertTrue(0 < sum(expected) < len(expected))
+        self.assertEqual(LabelRows(df, HandParser(), method3.CompareSimilarity, prepare=method3.IndexSVO), expected)
+
 # python -m unittest testing
 if __name__ == "__main__":
     unittest.main()